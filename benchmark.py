@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from tabulate import tabulate
+
+from lib.log import *
+from lib.mock_conductor import FILE_SIZE, FLOWS, NODES, ROUTERS, SERVICES, USERS, \
+    Fleet, MockConductor
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGIN = ['-c', '{host}', '-u', 'admin', '-p', 'admin']
+LOG_DIR = '/var/log/128technology'
+# name, script, arguments, stdin, requirements - "default-host" (localhost:443)
+# or a directory, which has to exist
+SCENARIOS = (
+    ('get-session-stats', 'get-session-stats.py', LOGIN + ['--json'], None, ()),
+    ('find-session-pcaps', 'find-session-pcaps.py',
+     LOGIN + ['-s', 'capture', '--no-download'], None, ()),
+    ('prefix-conflicts', 't128-show-ip-prefix-conflicts.py', LOGIN, None, ()),
+    ('prefix-conflicts-cross', 't128-show-ip-prefix-conflicts.py',
+     LOGIN + ['--cross-service'], None, ()),
+    ('set-transmit-cap', 't128-set-transmit-cap.py',
+     LOGIN + ['-r', '{router}', '-n', '{node}', '-i', 'wan', '-t', '1000000', '--commit'],
+     None, ()),
+    ('manage-users', 't128-manage-users.py', LOGIN + ['--dry-run', '--delete'],
+     'user000,User 0,user,local,secret\nnew,New User,admin,remote,\n', ()),
+    ('export-config', 'export-config.py',
+     ['--host', '{host}', '--user', 'admin', '--password', 'admin',
+      '--directory', '{workdir}', '--download'], None, ()),
+    ('export-to-quickstart', 'export_to_quickstart.py',
+     ['-e', '{export}', '-d', '{workdir}/quickstarts'], None, ()),
+    ('kill-sessions', 'kill-sessions.py', ['--dry-run', '--quiet', '--port', '500'], None,
+     ('default-host',)),
+    ('kill-stuck-esp', 'kill-stuck-esp.py', ['--dry-run', '--quiet'], None,
+     ('default-host', LOG_DIR)),
+)
+
+
+def parse_arguments():
+    """Get commandline arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scripts against a local mock conductor')
+    parser.add_argument('--port', type=int, default=443,
+                        help='port of the mock conductor - scripts without a host '
+                             'option need 443 (default: 443)')
+    parser.add_argument('--routers', type=int, default=ROUTERS,
+                        help='number of routers (default: {})'.format(ROUTERS))
+    parser.add_argument('--nodes', type=int, default=NODES,
+                        help='number of nodes per router (default: {})'.format(NODES))
+    parser.add_argument('--flows', type=int, default=FLOWS,
+                        help='number of flows per node (default: {})'.format(FLOWS))
+    parser.add_argument('--services', type=int, default=SERVICES,
+                        help='number of services (default: {})'.format(SERVICES))
+    parser.add_argument('--users', type=int, default=USERS,
+                        help='number of users (default: {})'.format(USERS))
+    parser.add_argument('--file-size', type=int, default=FILE_SIZE,
+                        help='size of log files in bytes (default: {})'.format(FILE_SIZE))
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay each request by X seconds')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run each scenario X times and keep the fastest run')
+    parser.add_argument('--scenario', action='append',
+                        help='run only this scenario (can be repeated)')
+    parser.add_argument('--json',
+                        help='write results to this file')
+    parser.add_argument('--compare',
+                        help='compare with results of an earlier run (json file)')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='report a regression above X percent (default: 20)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show output of the scripts')
+    return parser.parse_args()
+
+
+def run_script(script, arguments, stdin, workdir, verbose=False):
+    """Run a script and return (exit code, seconds, peak RSS in MB)."""
+    env = dict(os.environ, HOME=workdir)
+    output = None if verbose else subprocess.DEVNULL
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, script)] + arguments,
+        cwd=workdir, env=env, stdin=subprocess.PIPE, stdout=output, stderr=output)
+    if stdin:
+        process.stdin.write(stdin.encode())
+    process.stdin.close()
+    # wait4() returns the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, seconds, usage.ru_maxrss / 1024
+
+
+def run_scenarios(server, scenarios, workdir, repeat=1, verbose=False):
+    fleet = server.fleet
+    # key auth is used by scripts without login arguments
+    with open(os.path.join(workdir, 'pdc_ssh_key'), 'w') as fd:
+        fd.write('mock key')
+    export = os.path.join(workdir, 'export.gz')
+    with open(export, 'wb') as fd:
+        fd.write(fleet.config_export())
+    values = {
+        'host': server.address,
+        'workdir': workdir,
+        'export': export,
+        'router': fleet.routers[-1],
+        'node': fleet.nodes[fleet.routers[-1]][0]['name'],
+    }
+
+    results = {}
+    for name, script, arguments, stdin, requirements in scenarios:
+        missing = [r for r in requirements if r != 'default-host' and not os.path.isdir(r)]
+        if 'default-host' in requirements and server.server_address[1] != 443:
+            missing.append('mock conductor on port 443')
+        if missing:
+            warn('Skipping {} - it needs: {}'.format(name, ', '.join(missing)))
+            continue
+        arguments = [a.format(**values) for a in arguments]
+        best = None
+        for _ in range(repeat):
+            server.reset()
+            returncode, seconds, rss = run_script(script, arguments, stdin, workdir, verbose)
+            requests = sum(server.reset().values())
+            if best is None or seconds < best['seconds']:
+                best = {
+                    'returncode': returncode,
+                    'seconds': round(seconds, 3),
+                    'requests': requests,
+                    'rss': round(rss, 1),
+                }
+        if best['returncode']:
+            warn('{} has failed with exit code {}'.format(name, best['returncode']))
+        results[name] = best
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the regressions of results compared to baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ('seconds', 'requests', 'rss'):
+            old = baseline[name][key]
+            new = result[key]
+            if old and (new - old) * 100 / old > threshold:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def main():
+    args = parse_arguments()
+    scenarios = [s for s in SCENARIOS if not args.scenario or s[0] in args.scenario]
+    if not scenarios:
+        error('No scenario selected.')
+    fleet = Fleet(args.routers, args.nodes, args.flows, args.services, args.users,
+                  args.file_size)
+    try:
+        server = MockConductor(fleet, port=args.port, latency=args.latency)
+    except OSError as e:
+        error('Cannot start mock conductor:', e)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_scenarios(server, scenarios, workdir, args.repeat, args.verbose)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    rows = [(name, r['returncode'], r['seconds'], r['requests'], r['rss'])
+            for name, r in results.items()]
+    print(tabulate(rows, ['scenario', 'exit code', 'seconds', 'requests', 'peak RSS (MB)'],
+                   tablefmt='rst'))
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=4)
+
+    if args.compare:
+        try:
+            with open(args.compare) as fd:
+                baseline = json.load(fd)
+        except (OSError, ValueError) as e:
+            error('Cannot read results to compare with:', e)
+        regressions = compare(results, baseline, args.threshold)
+        for name, key, old, new in regressions:
+            warn('Regression in {}: {} {} -> {}'.format(name, key, old, new))
+        if regressions:
+            sys.exit(2)
+        info('No regressions found.')
+    if any(r['returncode'] for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
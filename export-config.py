@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
 import datetime
+import json
+import multiprocessing
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
 
-from lib.rest import RestGraphqlApi
+from lib.backup_store import BackupStore
+from lib.config_backup import BackupException, backup, backup_process
+from lib.log import *
 
 
-PREFIX = 'auto-backup-'
+FLEET_WORKERS = 8
+FLEET_TIMEOUT = 600
+# processes are started from worker threads - forking a threaded process is unsafe
+PROCESS_CONTEXT = multiprocessing.get_context('spawn')
 
 
 def parse_arguments():
@@ -25,64 +37,145 @@ def parse_arguments():
                         help='Keep backup files on the conductor/router after the download')
     parser.add_argument('--max-backups', type=int, default=3,
                         help='Delete too old backups (default: 3)')
+    parser.add_argument('--store', action='store_true',
+                        help='Keep downloads in a deduplicated backup store in --directory '
+                             '(--max-backups applies to the store)')
+    parser.add_argument('--delta', action='store_true',
+                        help='Save changed configs in the store as delta to the previous one')
+    parser.add_argument('--list', action='store_true',
+                        help='List the backups in the store in --directory')
+    parser.add_argument('--restore', metavar='NAME',
+                        help='Write backup NAME from the store in --directory as gzip export '
+                             'to --directory/NAME')
+    parser.add_argument('--inventory',
+                        help='Back up all targets in this file (lines: host[,user,password])')
+    parser.add_argument('--workers', type=int, default=FLEET_WORKERS,
+                        help='Targets to be backed up in parallel (default: {})'.format(FLEET_WORKERS))
+    parser.add_argument('--timeout', type=int, default=FLEET_TIMEOUT,
+                        help='Seconds per target before it is aborted (default: {})'.format(FLEET_TIMEOUT))
+    parser.add_argument('--summary',
+                        help='Write a json summary of the fleet backup to this file (default: stdout)')
     return parser.parse_args()
 
 
-def create_backup(api):
-    name = '{}{:%Y-%m-%d-%H-%M}'.format(PREFIX, datetime.datetime.now())
-    r = api.post('/config/export', {'filename': name, 'datastore': 'running'})
-    # return the filename without the path
-    filename = r.json()['exportPath'].replace('/etc/128technology/config-exports/', '')
-    return filename
-
-
-def delete_backup(api, filename):
-    r = api.delete('/config/export/{}'.format(filename))
-
-
-def delete_old_backups(api, max_backups=3):
-    generated_backups = []
-    r = api.get('/config/export')
-    for backup in r.json():
-        name = backup['name']
-        if name.startswith(PREFIX):
-            generated_backups.append(name)
-
-    generated_backups.sort(reverse=True)
-    # delete all but <max_backups> most recent backups
-    for backup in generated_backups[max_backups:]:
-        delete_backup(api, backup)
+def open_store(directory):
+    if not os.path.isdir(os.path.join(directory, 'backups')):
+        error('No backup store found in:', directory)
+    return BackupStore(directory)
+
+
+def list_backups(directory):
+    store = open_store(directory)
+    rows = []
+    for name in store.names():
+        pointer = store.read_pointer(name)
+        delta = os.path.exists(store.object_path(pointer['sha256'], delta=True))
+        rows.append((name, pointer['created'], pointer['sha256'], 'delta' if delta else 'full'))
+    print(tabulate(rows, ['name', 'created', 'sha256', 'stored as'], tablefmt='rst'))
+
+
+def restore_backup(directory, name):
+    store = open_store(directory)
+    if name not in store.names():
+        error('No backup found in store:', name)
+    path = os.path.join(directory, name)
+    try:
+        store.restore(name, path)
+    except OSError as e:
+        error('Could not restore backup:', e)
+    print('Restored config as:', path)
+
+
+def read_inventory(filename):
+    targets = []
+    try:
+        with open(filename) as fd:
+            for line in csv.reader(fd):
+                if not line or line[0].strip().startswith('#'):
+                    continue
+                host, user, password = (
+                    [field.strip() for field in line] + [None, None])[:3]
+                targets.append((host, user, password))
+    except OSError:
+        error('Cannot read inventory file:', filename)
+    return targets
+
+
+def backup_target(args, target):
+    """Back up one target in its own process, so it can be aborted on timeout."""
+    start = time.time()
+    receiver, sender = PROCESS_CONTEXT.Pipe(duplex=False)
+    process = PROCESS_CONTEXT.Process(target=backup_process, args=(sender, args, target))
+    process.start()
+    sender.close()
+    status = None
+    if receiver.poll(args.timeout):
+        try:
+            status, result = receiver.recv()
+        except EOFError:
+            # the process has died without sending a result
+            pass
+    elif process.is_alive():
+        process.terminate()
+        status, result = 'timeout', 'Aborted after {} seconds'.format(args.timeout)
+    process.join()
+    if status is None:
+        status, result = 'failed', 'Exit code: {}'.format(process.exitcode)
+    summary = {
+        'host': target[0],
+        'status': status,
+        'seconds': round(time.time() - start, 1),
+    }
+    if status == 'ok':
+        summary['backup'] = result
+    else:
+        summary['error'] = result
+    return summary
 
 
-def download_backup(api, directory, filename):
-    nonce = api.get('/nonce').json()['nonce']
-    r = api.get(f'/config/export/{filename}/download?nonce={nonce}')
-    # write the file to local disk
-    path = os.path.join(directory, filename)
-    with open(path, 'wb') as fd:
-        fd.write(r.content)
-        print('Successfully saved config as:', path)
+def backup_fleet(args):
+    """Back up all inventory targets in parallel and return a summary."""
+    targets = read_inventory(args.inventory)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        results = list(executor.map(lambda t: backup_target(args, t), targets))
+    return {
+        'started': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.fromtimestamp(start)),
+        'seconds': round(time.time() - start, 1),
+        'targets': len(results),
+        'failed': sum(r['status'] != 'ok' for r in results),
+        'results': results,
+    }
 
 
 def main():
     args = parse_arguments()
-    params = {}
-    if args.host:
-        params['host'] = args.host
-        if args.user and args.password:
-            params['user'] = args.user
-            params['password'] = args.password
-    api = RestGraphqlApi(**params)
-
-    filename = create_backup(api)
-    # when the file should be downloaded, just get the file (unless --keep is given)
-    # otherwise do a cleanup
-    if args.download:
-        download_backup(api, args.directory, filename)
-        if not args.keep:
-            delete_backup(api, filename)
-    else:
-        delete_old_backups(api, args.max_backups)
+    if args.list:
+        list_backups(args.directory)
+        return
+    if args.restore:
+        restore_backup(args.directory, args.restore)
+        return
+
+    if args.inventory:
+        summary = backup_fleet(args)
+        if args.summary:
+            with open(args.summary, 'w') as fd:
+                json.dump(summary, fd, indent=4)
+            for result in summary['results']:
+                if result['status'] != 'ok':
+                    warn('Backup of {} failed: {}'.format(result['host'], result['error']))
+        else:
+            # keep stdout machine-readable - failures are part of the summary
+            print(json.dumps(summary, indent=4))
+        if summary['failed']:
+            sys.exit(1)
+        return
+
+    try:
+        backup(args, args.host, args.user, args.password)
+    except BackupException as e:
+        error(e)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
 
-from lib.quickstart import Quickstart
+from lib.log import *
+from lib.quickstart import Quickstart, split_config_export
 
 
 def parse_arguments():
@@ -11,17 +14,49 @@ def parse_arguments():
         description='Convert an export config into quickstart')
     parser.add_argument('-e', '--export', required=True,
                         help='Export config file name')
-    parser.add_argument('-q', '--quickstart', required=True,
-                        help='Quickstart file name')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-q', '--quickstart',
+                       help='Quickstart file name')
+    group.add_argument('-d', '--directory',
+                       help='Write one quickstart per router node into this directory')
+    parser.add_argument('-r', '--router',
+                        help='Router for --quickstart (default: last router in the export)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Quickstart files to be compressed in parallel')
     return parser.parse_args()
 
 
+def write_quickstart(quickstart, directory):
+    filename = os.path.join(directory, '{}_{}.quickstart'.format(
+        quickstart.router_name, quickstart.node_name))
+    with open(filename, 'wb') as fd:
+        quickstart.write(fd)
+    return filename
+
+
+def write_quickstarts(export, directory, workers=1):
+    """Write quickstart files for all routers of an authority export."""
+    os.makedirs(directory, exist_ok=True)
+    # zlib releases the GIL - compress in threads
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(lambda q: write_quickstart(q, directory),
+                                 split_config_export(export)))
+
+
 def main():
     args = parse_arguments()
+    if args.directory:
+        for filename in write_quickstarts(args.export, args.directory, args.workers):
+            info('Written quickstart:', filename)
+        return
+
     quickstart = Quickstart()
-    quickstart.read_config_export(args.export)
+    try:
+        quickstart.read_config_export(args.export, args.router)
+    except ValueError as e:
+        error(e)
     with open(args.quickstart, 'wb') as fd:
-        fd.write(quickstart.to_bytes())
+        quickstart.write(fd)
 
 
 if __name__ == '__main__':
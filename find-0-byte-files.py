@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
 import pkgutil
+import stat
 from subprocess import run
 from lib.log import *
 
@@ -19,7 +23,7 @@ WHITELIST = (
     '/home/admin/.ssh/pdc_ssh_key',
     '/home/admin/.ssh/pdc_ssh_key.pub',
 )
-IGNORE_DIRS = (
+IGNORE_DIRS = {
     '/dev',
     '/etc/128technology/system.demon',
     '/etc/wanpipe/api',
@@ -32,13 +36,13 @@ IGNORE_DIRS = (
     '/var/lib/128technology/influxdb/wal/t128',
     '/var/log',
     '/var/spool',
-)
-IGNORE_FILES = (
+}
+IGNORE_FILES = {
     '__init__.pxd',
     '__init__.py',
     '__init__.pyi',
     'py.typed',
-)
+}
 IGNORE_EXTENSIONS = (
     '.gpg',
     '.gpg~',
@@ -73,6 +77,13 @@ def parse_arguments():
     parser.add_argument('--whitelist-file', help='use additional file as whitelist')
     parser.add_argument('--quiet', '-q', action='store_true',
                         help='no output')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of directory trees to be scanned in parallel')
+    parser.add_argument('--index-file',
+                        help='incremental mode: keep directory mtimes and results in this file '
+                             'and only rescan changed directories')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='ignore the content of --index-file and scan all directories')
     return parser.parse_args()
 
 
@@ -86,66 +97,192 @@ def call(cmd, list, no_arg=False, one_arg=False):
 
 
 def read_ignore_list(ignore_file):
-    ignore_list = []
+    ignore_list = set()
     data = pkgutil.get_data('ignore', 'ignore_list')
-    ignore_list.extend(data.decode('ascii').splitlines())
+    ignore_list.update(data.decode('ascii').splitlines())
     if ignore_file:
         try:
             with open(ignore_file) as fd:
                 for line in fd.readlines():
-                    ignore_list.append(line.strip())
+                    ignore_list.add(line.strip())
         except:
             error('Cannot read ignore file:', ignore_file)
     return ignore_list
 
 
 def read_white_list(whitelist_file):
-    white_list = list(WHITELIST)
+    white_list = set(WHITELIST)
     if whitelist_file:
         try:
             with open(whitelist_file) as fd:
                 for line in fd.readlines():
-                    white_list.append(line.strip())
+                    white_list.add(line.strip())
         except:
             error('Cannot read whitelist file:', whitelist_file)
     return white_list
 
 
+def scan_files(path, ignore_list):
+    """Return zero byte files and subdirectories of a single directory.
+
+    Only the cached data of the directory entries is used, which needs at
+    most one stat call per entry (for regular files and symlinks).
+    """
+    zero_bytes = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # like os.walk() - do not follow symlinks to directories
+                    if not entry.is_symlink() and entry.path not in IGNORE_DIRS:
+                        dirs.append(entry.path)
+                    continue
+
+                # check ignore lists
+                file = entry.name
+                if file in IGNORE_FILES:
+                    continue
+                if file.lower().endswith(IGNORE_EXTENSIONS):
+                    continue
+                name = entry.path
+                if name in ignore_list:
+                    continue
+
+                try:
+                    # ignore broken symlinks and other non-files
+                    if entry.is_file() and entry.stat().st_size == 0:
+                        zero_bytes.append(name)
+                except OSError:
+                    # file was removed in the meantime
+                    pass
+    except OSError:
+        # directory cannot be read - same as os.walk()
+        pass
+    return zero_bytes, dirs
+
+
+def is_zero_byte_file(name):
+    try:
+        st = os.stat(name)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size == 0
+
+
+def scan_dir(path, ignore_list, index, new_index):
+    """Like scan_files(), but reuse the cached results of unchanged directories.
+
+    The mtime of a directory only changes when entries are added, removed or
+    renamed. Cached zero byte files are checked again, but files truncated
+    to 0 bytes in an unchanged directory are only found by a full rescan.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return [], []
+    cached = index.get(path)
+    if cached and cached[0] == mtime:
+        zero_bytes = [os.path.join(path, name) for name in cached[1]]
+        zero_bytes = [name for name in zero_bytes if is_zero_byte_file(name)]
+        dirs = [os.path.join(path, name) for name in cached[2]]
+    else:
+        zero_bytes, dirs = scan_files(path, ignore_list)
+    new_index[path] = [mtime,
+                       [os.path.basename(name) for name in zero_bytes],
+                       [os.path.basename(name) for name in dirs]]
+    return zero_bytes, dirs
+
+
+def scan_tree(path, ignore_list, index=None):
+    """Scan a directory tree top-down in the same order as os.walk().
+
+    If an index is given, the results are returned together with an updated
+    index for the tree.
+    """
+    found_zero_bytes = []
+    new_index = {}
+    pending = [path]
+    while pending:
+        if index is None:
+            zero_bytes, dirs = scan_files(pending.pop(), ignore_list)
+        else:
+            zero_bytes, dirs = scan_dir(pending.pop(), ignore_list, index, new_index)
+        found_zero_bytes.extend(zero_bytes)
+        pending.extend(reversed(dirs))
+    return found_zero_bytes, new_index
+
+
+def scan(start_dir, ignore_list, workers=1, index=None):
+    """Find zero byte files - top-level subtrees are scanned in parallel."""
+    new_index = {}
+    if index is None:
+        found_zero_bytes, dirs = scan_files(start_dir, ignore_list)
+    else:
+        found_zero_bytes, dirs = scan_dir(start_dir, ignore_list, index, new_index)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for zero_bytes, tree_index in executor.map(
+                lambda d: scan_tree(d, ignore_list, index), dirs):
+            found_zero_bytes.extend(zero_bytes)
+            new_index.update(tree_index)
+    return found_zero_bytes, new_index
+
+
+def ignore_list_hash(ignore_list):
+    data = '\n'.join(sorted(ignore_list)).encode()
+    return hashlib.sha1(data).hexdigest()
+
+
+def read_index(index_file, ignore_list):
+    """Load the directory index - it is only valid for the same ignore list."""
+    try:
+        with open(index_file) as fd:
+            data = json.load(fd)
+    except (OSError, ValueError):
+        return {}
+    if data.get('ignore') != ignore_list_hash(ignore_list):
+        return {}
+    return data.get('dirs', {})
+
+
+def write_index(index_file, ignore_list, index):
+    data = {
+        'ignore': ignore_list_hash(ignore_list),
+        'dirs': index,
+    }
+    tmp_file = index_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as fd:
+            json.dump(data, fd, separators=(',', ':'))
+        os.replace(tmp_file, index_file)
+    except OSError:
+        warn('Cannot write index file:', index_file)
+
+
 def main():
     args = parse_arguments()
     ignore_list = read_ignore_list(args.ignore_file)
     white_list = read_white_list(args.whitelist_file)
-    found_zero_bytes = []
+    index = None
+    if args.index_file:
+        index = {}
+        if not args.full_rescan:
+            index = read_index(args.index_file, ignore_list)
+    found_zero_bytes, new_index = scan(args.start_dir, ignore_list, args.workers, index)
+    if args.index_file:
+        write_index(args.index_file, ignore_list, new_index)
     found_whitelisted = []
-    # check all files in start_dir
-    for root, dirs, files in os.walk(args.start_dir):
-        for dir in dirs[:]:
-            path = os.path.join(root, dir)
-            if path in IGNORE_DIRS:
-                dirs.remove(dir)
-
-        for file in files:
-            name = os.path.join(root, file)
-            low = file.lower()
-
-            # check ignore lists
-            if file in IGNORE_FILES:
-                continue
-            if any([low.endswith(extension) for extension in IGNORE_EXTENSIONS]):
-                continue
-            if name in ignore_list:
-                continue
-
-            if os.path.isfile(name):    # ignore symlinks and other non-files
-                size = os.path.getsize(name)
-                if size == 0:
-                    found_zero_bytes.append(name)
-                    if args.show_zero:
-                        info('zero-bytes:', name)
-                    if name in white_list:
-                        found_whitelisted.append(name)
-                        if args.show_whitelisted:
-                            info('whitelisted:', name)
+    for name in found_zero_bytes:
+        if args.show_zero:
+            info('zero-bytes:', name)
+        if name in white_list:
+            found_whitelisted.append(name)
+            if args.show_whitelisted:
+                info('whitelisted:', name)
 
     # removing files if requested
     if args.remove_zero:
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+from requests import RequestException
 
 from lib.log import *
-from lib.rest import RestApi
+from lib.rest import MAX_WORKERS, FileDownloadException, MissingNonceException, \
+    RestGraphqlApi
+
+
+MAX_DOWNLOADS = 4
 
 
 def parse_arguments():
@@ -26,15 +31,38 @@ def parse_arguments():
                         help='Do not download pcaps')
     parser.add_argument('--selected-routers',
                         help='Comma separated list of routers to be checked')
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS,
+                        help='Routers to be searched concurrently (default: {})'.format(MAX_WORKERS))
+    parser.add_argument('--max-downloads', type=int, default=MAX_DOWNLOADS,
+                        help='Concurrent pcap downloads (default: {})'.format(MAX_DOWNLOADS))
     return parser.parse_args()
 
 
+def find_pcaps(api, router, nodes, string, first_only=False):
+    """Return (router, node, filename) of all matching pcaps on a router."""
+    pcaps = []
+    for node in nodes:
+        location = '/router/{}/node/{}/logs/collapsed'.format(router, node)
+        r = api.get(location)
+        if r.status_code == 200:
+            for file in r.json():
+                if file['type'] == 'pcap' and string in file['name']:
+                    pcaps.append((router, node, file['name']))
+                    if first_only:
+                        break
+    return pcaps
+
+
 def download_pcap(api, router, node, filename):
     local_filename = '/tmp/{}_{}'.format(router, filename)
     print('local_filename:', local_filename)
-    with open(local_filename, 'wb') as fd:
-        for chunk in api.download_file(router, node, filename):
-            fd.write(chunk)
+    location = '/router/{}/node/{}/logs/collapsed/download?file={}'.format(
+        router, node, filename)
+    try:
+        # resumable and verified - the file appears only, when it is complete
+        api.download(location, local_filename, nonce=True)
+    except (FileDownloadException, MissingNonceException, RequestException, OSError) as e:
+        warn('Could not download {} from {}: {}'.format(filename, router, e))
 
 
 def main():
@@ -43,34 +71,30 @@ def main():
         'host': args.host,
         'user': args.user,
         'password': args.password,
+        'max_workers': args.workers,
     }
-    api = RestApi(**params)
-    found_routers = []
+    api = RestGraphqlApi(**params)
     if args.selected_routers:
         routers = args.selected_routers.split(',')
     else:
         routers = api.get_router_names()
-    for router in routers:
-        if args.ignore_routers:
-            ignore = False
-            for pattern in args.ignore_routers.split(','):
-                if pattern in router:
-                    ignore = True
-                    break
-            if ignore:
-                continue
-
-        for node in api.get_node_names(router):
-            location = '/router/{}/node/{}/logs/collapsed'.format(router, node)
-            r = api.get(location)
-            if r.status_code == 200:
-                for file in r.json():
-                    if file['type'] == 'pcap' and args.string in file['name']:
-                        found_routers.append(router)
-                        if args.no_download:
-                            break
-                        else:
-                            download_pcap(api, router, node, file['name'])
+    if args.ignore_routers:
+        patterns = args.ignore_routers.split(',')
+        routers = [r for r in routers if not any(p in r for p in patterns)]
+
+    # get node names with batched queries and
+    # search all routers concurrently - results keep the router order
+    router_nodes = api.get_router_nodes(routers, fields=('name',))
+    pcaps = [pcap for router_pcaps in api.map(
+                 lambda router: find_pcaps(api, router,
+                                           [n['name'] for n in router_nodes[router]],
+                                           args.string, args.no_download),
+                 routers)
+             for pcap in router_pcaps]
+    found_routers = list(dict.fromkeys(router for router, _, _ in pcaps))
+
+    if not args.no_download:
+        api.map(lambda pcap: download_pcap(api, *pcap), pcaps, args.max_downloads)
 
     if args.show_routers or args.no_download:
         print('Routers that have matching pcap files:')
@@ -1,27 +1,65 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import json
+import sys
 
-from lib.rest import RestGraphqlApi
+from lib.log import *
+from lib.rest import MAX_WORKERS, RestGraphqlApi
+
+
+def kpi_query(id):
+    return {
+        'id': id,
+        'window': {
+            'start': 'now-86400',
+            'end': 'now-10'
+        },
+        'order': 'ascending',
+    }
+
+
+def kpi_values(request):
+    if request.status_code == 200:
+        #print('request:', request.json())
+        values = [e.get('value', 0) for e in request.json() if 'value' in e]
+        return values
 
 
 class _Api(RestGraphqlApi):
     """Override imported class for additional methods."""
     def get_kpi(self, router_name, id):
-        json = {
-            'id': id,
-            'window': {
-                'start': 'now-86400',
-                'end': 'now-10'
-            },
-            'order': 'ascending',
-        }
-        request = self.post('/router/{}/metrics'.format(router_name), json=json)
-        if request.status_code == 200:
-            #print('request:', request.json())
-            values = [e.get('value', 0) for e in request.json() if 'value' in e]
-            return values
+        request = self.post('/router/{}/metrics'.format(router_name), json=kpi_query(id))
+        return kpi_values(request)
+
+
+def get_kpis_async(parameters, jobs, max_concurrency):
+    """Get KPIs with the asyncio API - results keep the order of jobs."""
+    try:
+        from lib.rest_async import AsyncRestGraphqlApi
+    except ImportError as e:
+        error(e)
+
+    class _AsyncApi(AsyncRestGraphqlApi):
+        async def get_kpi(self, router_name, id):
+            request = await self.post('/router/{}/metrics'.format(router_name),
+                                      json=kpi_query(id))
+            return kpi_values(request)
+
+    async def run():
+        async with _AsyncApi(max_concurrency=max_concurrency, **parameters) as api:
+            return await api.map(lambda job: api.get_kpi(*job), jobs)
+    return asyncio.run(run())
+
+
+def is_router(nodes):
+    for node in nodes:
+        if node.get('role') == 'conductor':
+            return False
+        if node.get('role') == 'combo':
+            return True
+    return False
 
 
 def parse_arguments():
@@ -44,6 +82,17 @@ def parse_arguments():
                         help='Use NULL instead of empty string if no value could be retrieved')
     parser.add_argument('--round', action='store_true',
                         help='Round values instead of using float numbers')
+    parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS,
+                        help='Concurrent requests to the conductor (default: {})'.format(MAX_WORKERS))
+    parser.add_argument('--pool-size', type=int,
+                        help='Connections to keep alive (default: number of workers)')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Retry failed requests with exponential backoff')
+    parser.add_argument('--pool-stats', action='store_true',
+                        help='Show connection pool statistics on stderr')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Get KPIs with asyncio - --workers requests in flight '
+                             '(needs aiohttp, see requirements-async.txt)')
     return parser.parse_args()
 
 
@@ -67,35 +116,44 @@ def main():
     keys = ('host', 'user', 'password')
     parameters = {k: v for k, v in args.__dict__.items() if k in keys and v}
     parameters['app'] = __file__
+    parameters['max_workers'] = args.workers
+    parameters['pool_size'] = args.pool_size
+    parameters['max_retries'] = args.retries
     api = _Api(**parameters)
 
+    # get the nodes of all routers with batched queries and
+    # query all routers concurrently - results keep the router order
+    router_names = api.get_router_names()
+    router_nodes = api.get_router_nodes(router_names)
+    routers = [r for r in router_names if is_router(router_nodes[r])]
+    jobs = [(router_name, id) for router_name in routers for id in kpi_ids]
+    if args.use_async:
+        async_parameters = {k: v for k, v in parameters.items() if k in keys + ('app',)}
+        if args.pool_size:
+            async_parameters['pool_size'] = args.pool_size
+        kpis = dict(zip(jobs, get_kpis_async(async_parameters, jobs, args.workers)))
+    else:
+        kpis = dict(zip(jobs, api.map(lambda job: api.get_kpi(*job), jobs)))
+
     stats = {}
-    for router_name in api.get_router_names():
-        is_router = False
-        for node in api.get_nodes(router_name):
-            if node.get('role') == 'conductor':
-                break
-            if node.get('role') == 'combo':
-                is_router = True
-                break
-        if is_router:
-            router_kpis = {}
-            for id in kpi_ids:
-                values = api.get_kpi(router_name, id)
-                if values:
-                    # KPI for the interval is defined as max of values
-                    aggregated_value = aggregate(values)
-                    if args.round:
-                        router_kpis[id] = round(aggregated_value)
-                    else:
-                        router_kpis[id] = aggregated_value
+    for router_name in routers:
+        router_kpis = {}
+        for id in kpi_ids:
+            values = kpis[(router_name, id)]
+            if values:
+                # KPI for the interval is defined as max of values
+                aggregated_value = aggregate(values)
+                if args.round:
+                    router_kpis[id] = round(aggregated_value)
+                else:
+                    router_kpis[id] = aggregated_value
+            else:
+                if args.null:
+                    router_kpis[id] = None
                 else:
-                    if args.null:
-                        router_kpis[id] = None
-                    else:
-                        router_kpis[id] = ''
-            if router_kpis:
-                stats[router_name] = router_kpis
+                    router_kpis[id] = ''
+        if router_kpis:
+            stats[router_name] = router_kpis
 
     if args.json:
         print(json.dumps(stats, indent=4))
@@ -105,6 +163,9 @@ def main():
         for line in lines:
             print(','.join([str(num) for sublist in line for num in sublist]))
 
+    if args.pool_stats:
+        print('Connection pool:', api.connection_stats(), file=sys.stderr)
+
 
 if __name__ == '__main__':
     main()
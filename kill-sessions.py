@@ -7,11 +7,23 @@ import sys
 from requests import ConnectTimeout, ReadTimeout
 from tabulate import tabulate
 
+from lib.flow_table import FlowTable
 from lib.log import *
-from lib.rest import RestApi
+from lib.session_filter import FilterException, SessionFilter
+from lib.rest import FLOW_PAGE_SIZE, MAX_WORKERS, GraphqlException, RestGraphqlApi
 
 DAEMONS = ['mars']
 KILL_COMMAND = ['pkill', '-x']
+FLOW_FIELDS = [
+    'sessionUuid',
+    'serviceName',
+    'sourceIp',
+    'sourcePort',
+    'destIp',
+    'destPort',
+    'encrypted',
+    'networkInterfaceName',
+]
 
 
 def parse_arguments():
@@ -27,39 +39,48 @@ def parse_arguments():
                         help='kill related daemons if api does not respond with X seconds')
     parser.add_argument('--same-interface', action='store_true',
                         help='Same ingress/egress interface')
+    parser.add_argument('--filter', action='append',
+                        help='match sessions by terms like "service=internet,voice* '
+                             'ip=10.0.0.0/8 port=500,4500 dport=8000-8100 protocol=udp '
+                             'encrypted=no interface=wan node=node1 age>1h same-interface" '
+                             '(!= negates a term, all terms have to match, '
+                             'a session matches if any --filter matches)')
+    parser.add_argument('--page-size', type=int, default=FLOW_PAGE_SIZE,
+                        help='number of flows per request (default: {})'.format(FLOW_PAGE_SIZE))
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='number of concurrent deletes (default: {})'.format(MAX_WORKERS))
     return parser.parse_args()
 
 
+def get_session_filter(args):
+    """Compile --filter options - --port and --same-interface are added to each."""
+    terms = []
+    if args.port:
+        terms.append('port={}'.format(args.port))
+    if args.same_interface:
+        terms.append('same-interface')
+    filters = [' '.join([f] + terms) for f in args.filter or ['']]
+    try:
+        return SessionFilter(filters)
+    except FilterException as e:
+        error('Invalid filter:', e)
+
+
 def get_filtered_sessions(api, args):
-    json = {
-        'query': '''
-            {
-              allNodes {
-                nodes {
-                  flowEntries(first: 100000) {
-                    nodes {
-                      sessionUuid
-                      serviceName
-                      sourceIp
-                      sourcePort
-                      destIp
-                      destPort
-                      encrypted
-                      networkInterfaceName
-                    }
-                  }
-                }
-              }
-            }
-        '''
-    }
     kwargs = {}
     timeout = args.kill_daemons
     if timeout:
         print('Timeout:', timeout)
         kwargs['timeout'] = timeout
+
+    session_filter = get_session_filter(args)
+    fields = FLOW_FIELDS + [f for f in session_filter.fields
+                            if f not in FLOW_FIELDS and f != 'nodeName']
+    table = FlowTable()
+    filtered_sessions = {}
     try:
-        request = api.post('/graphql', json, **kwargs)
+        # store flows column-wise while they are streamed
+        table.extend(api.iter_flows(fields, args.page_size, **kwargs))
     except (ConnectTimeout, ReadTimeout):
         print('Getting sessions took too long. Killing daemons:', *DAEMONS)
         if not args.dry_run:
@@ -68,58 +89,26 @@ def get_filtered_sessions(api, args):
                 time.sleep(1)
                 subprocess.call(KILL_COMMAND + ['-9', daemon])
         sys.exit(1)
+    except (GraphqlException, ValueError) as e:
+        error('Retrieving sessions table has failed:', e)
 
-    sessions = {}
-    filtered_sessions = {}
-    retrieval_failed = False
-    if request.status_code == 200:
-        # aggregate flows into sessions
-        try:
-            for flow in request.json()['data']['allNodes']['nodes'][0]['flowEntries']['nodes']:
-                id = flow['sessionUuid']
-                if id not in sessions:
-                    sessions[id] = []
-                sessions[id].append(flow)
-        except TypeError:
-            retrieval_failed = True
-
-        if not args.quiet:
-            print('Total number of sessions:', len(sessions))
-
-        for flows in sessions.values():
-            interfaces = [flow['networkInterfaceName'] for flow in flows]
-            for flow in flows:
-                if args.port:
-                    if args.port not in (flow['sourcePort'], flow['destPort']):
-                        # no match - ignore this flow
-                        continue
-                if args.same_interface:
-                    if len(set(interfaces)) != 1:
-                        # no match - ignore this flow
-                        continue
-                    if interfaces[0] == '<InternalApplication>':
-                        # ignore internal application
-                        continue
-
-                # all criteria are met - add session to filtered_sessions
-                id = flow['sessionUuid']
-                filtered_sessions[id] = sessions[id]
-                break
+    if not args.quiet:
+        print('Total number of sessions:', table.session_count())
 
-        if not args.quiet:
-            print('Matching number of sessions:', len(filtered_sessions))
-        return filtered_sessions
+    # one pass over all sessions - the filter is compiled for this table
+    match = session_filter.compile(table)
+    for id, rows in table.sessions():
+        if match(rows):
+            filtered_sessions[id] = table.flows(id)
 
-    else:
-        retrieval_failed = True
+    if not args.quiet:
+        print('Matching number of sessions:', len(filtered_sessions))
+    return filtered_sessions
 
-    if retrieval_failed:
-        error('Retrieving sessions table has failed: {} ({})'.format(
-              request.text, request.status_code))
 
 def main():
     args = parse_arguments()
-    api = RestApi()
+    api = RestGraphqlApi(max_workers=args.workers)
     filtered_sessions = get_filtered_sessions(api, args)
 
     if filtered_sessions:
@@ -132,13 +121,13 @@ def main():
             print(tabulate(rows, header, tablefmt='rst'))
 
         if not args.dry_run:
-            for id in filtered_sessions.keys():
-                location = '/router/{}/node/{}/traffic/session?sessionId={}'.format(
-                    api.get_router_name(),
-                    api.get_node_name(),
-                    id,
-                )
-                api.delete(location)
+            sessions = {id: flows[0].get('nodeName') for id, flows in filtered_sessions.items()}
+            results = api.delete_sessions(sessions)
+            failed = {id: message for id, (success, message) in results.items() if not success}
+            if not args.quiet:
+                print('Deleted sessions:', len(results) - len(failed))
+                for id, message in failed.items():
+                    warn('Could not delete session {}: {}'.format(id, message))
 
 
 if __name__ == '__main__':
@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 
 import argparse
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 import os
 import subprocess
 import sys
 import time
-from requests import ConnectTimeout, ReadTimeout
+from requests import ConnectTimeout, ReadTimeout, RequestException
 from tabulate import tabulate
 
+from lib.flow_table import SNAPSHOT_MAGIC, FlowTable
 from lib.log import *
-from lib.rest import RestApi
+from lib.rest import FLOW_PAGE_SIZE, MAX_WORKERS, GraphqlException, RestGraphqlApi
 
 
 IKE_PORT = 500
+LOG_DIR = '/var/log/128technology'
+SESSIONS_LOG = os.path.join(LOG_DIR, 'stuck-esp-sessions.json.log')
+DELTA_LOG = os.path.join(LOG_DIR, 'stuck-esp-sessions.delta.log')
+MAX_INTERVAL = 600
+# back off, when a poll takes longer than this part of the --watch interval
+SLOW_POLL = 0.5
+START_TIME_FORMAT = '%Y-%m-%d %H:%M:%S +0000 (UTC)'
+FLOW_FIELDS = [
+    'sessionUuid',
+    'serviceName',
+    'protocol',
+    'sourceIp',
+    'sourcePort',
+    'destIp',
+    'destPort',
+    'networkInterfaceName',
+    'forward',
+    'startTime',
+]
 
 
 def parse_arguments():
@@ -23,142 +43,215 @@ def parse_arguments():
         description='Kill sessions on 128T/SSR router, when ESP and IKE paths differ')
     parser.add_argument('--timeout', type=int,
                         help='wait X seconds on API calls')
+    parser.add_argument('--page-size', type=int, default=FLOW_PAGE_SIZE,
+                        help='number of flows per request (default: {})'.format(FLOW_PAGE_SIZE))
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='number of concurrent deletes (default: {})'.format(MAX_WORKERS))
     parser.add_argument('--dry-run', action='store_true',
                         help='show sessions only - no kill')
     parser.add_argument('--test-file',
-                        help='Load sessions from file for testing')
+                        help='Load sessions from file (json or snapshot) for testing')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='write the retrieved flows to a binary snapshot file')
+    parser.add_argument('--convert', nargs=2, metavar=('JSON_FILE', 'SNAPSHOT_FILE'),
+                        help='convert a sessions json file to a snapshot and exit')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--quiet', action='store_true',
                         help='no output')
     group.add_argument('--print-sessions', action='store_true',
                         help='show session details')
     group.add_argument('--print-sessions-from-file',
-                        help='Load file and show session details')
+                        help='Load file (json or snapshot) and show session details')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='keep running and poll sessions every X seconds')
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL,
+                        help='longest poll interval, when the API is slow or fails '
+                             '(default: {})'.format(MAX_INTERVAL))
     return parser.parse_args()
 
 
+def format_flow(flow, now):
+    """Add the duration and a readable start time to a flow."""
+    duration = now - flow['startTime']
+    days = duration // 86400
+    hours = (duration % 86400) // 3600
+    minutes = (duration % 3600) // 60
+    seconds = duration % 60
+    duration_string = ''
+    if days:
+        duration_string += '{}d '.format(days)
+    duration_string += '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    flow['duration'] = duration_string
+    flow['startTime'] = datetime.utcfromtimestamp(flow['startTime']).strftime(
+        START_TIME_FORMAT)
+    return flow
+
+
+def parse_flow(flow):
+    """Revert format_flow() - return the flow and the time it was formatted."""
+    flow = dict(flow)
+    flow.pop('client', None)
+    duration = flow.pop('duration', None)
+    if duration is None:
+        # not formatted
+        return flow, None
+    days = 0
+    if 'd ' in duration:
+        days, duration = duration.split('d ')
+    hours, minutes, seconds = duration.split(':')
+    start = int(datetime.strptime(flow['startTime'], START_TIME_FORMAT).replace(
+        tzinfo=timezone.utc).timestamp())
+    flow['startTime'] = start
+    now = start + int(days) * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return flow, now
+
+
+def get_flow_table(api, args):
+    kwargs = {}
+    if args.timeout:
+        kwargs['timeout'] = args.timeout
+    # store flows column-wise while they are streamed
+    return FlowTable().extend(api.iter_flows(FLOW_FIELDS, args.page_size, **kwargs))
+
+
+def save_snapshot(table, filename, now):
+    try:
+        table.save(filename, {'time': now})
+    except OSError as e:
+        warn('Could not write snapshot:', e)
+
+
 def get_filtered_sessions(api, args):
-    json = {
-        'query': '''
-            {
-              allNodes {
-                nodes {
-                  flowEntries(first: 100000) {
-                    nodes {
-                      sessionUuid
-                      serviceName
-                      protocol
-                      sourceIp
-                      sourcePort
-                      destIp
-                      destPort
-                      networkInterfaceName
-                      forward
-                      startTime
-                    }
-                  }
-                }
-              }
-            }
-        '''
-    }
     try:
-        request = api.post('/graphql', json, timeout=args.timeout)
+        table = get_flow_table(api, args)
     except (ConnectTimeout, ReadTimeout):
         error('Getting sessions took too long.')
-
-    sessions = {}
+    except (GraphqlException, ValueError) as e:
+        error('Retrieving sessions table has failed:', e)
+    info('Total number of sessions:', table.session_count())
+    now = int(time.time())
+    if args.snapshot:
+        save_snapshot(table, args.snapshot, now)
+    return filter_sessions(table, now)
+
+
+def sessions_to_table(filtered_sessions):
+    """Build a flow table from filtered (formatted) sessions.
+
+    Return the table and the time, when the sessions have been retrieved.
+    """
+    flows = []
+    now = None
+    for sessions in filtered_sessions.values():
+        for session_flows in sessions.values():
+            for flow in session_flows:
+                flow, formatted = parse_flow(flow)
+                flows.append(flow)
+                now = formatted or now
+    return FlowTable().extend(flows), now
+
+
+def load_sessions(filename):
+    """Load filtered sessions from a json file or a binary snapshot."""
+    with open(filename, 'rb') as fd:
+        magic = fd.read(len(SNAPSHOT_MAGIC))
+    if magic == SNAPSHOT_MAGIC:
+        table = FlowTable.load(filename)
+        return filter_sessions(table, table.meta.get('time'))
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def filter_sessions(table, now=None):
+    # Search IKE sessions - only their flows are converted and formatted
+    source_ports = table.column('sourcePort')
+    dest_ports = table.column('destPort')
+    protocols = table.column('protocol')
+    esp = table.code('ESP')
+    if now is None:
+        now = int(time.time())
     filtered_sessions = {}
-    retrieval_failed = False
-    if request.status_code == 200:
-        # aggregate flows into sessions
-        try:
-            for flow in request.json()['data']['allNodes']['nodes'][0]['flowEntries']['nodes']:
-                id = flow['sessionUuid']
-
-                duration = int(time.time()) - flow['startTime']
-                days = duration // 86400
-                hours = (duration % 86400) // 3600
-                minutes = (duration % 3600) // 60
-                seconds = duration % 60
-                duration_string = ''
-                if days:
-                    duration_string += '{}d '.format(days)
-                duration_string += '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
-                flow['duration'] = duration_string
-                flow['startTime'] = '{:%Y-%m-%d %H:%M:%S +0000 (UTC)}'.format(
-                    datetime.utcfromtimestamp(flow['startTime']))
-
-                if id not in sessions:
-                    sessions[id] = []
-                sessions[id].append(flow)
-        except (TypeError, IndexError):
-            retrieval_failed = True
-
-        info('Total number of sessions:', len(sessions))
-
-        # Search IKE sessions
-        filtered_sessions = {}
-        for flows in sessions.values():
-            interfaces = [flow['networkInterfaceName'] for flow in flows]
-            for flow in flows:
-                if IKE_PORT not in (flow['sourcePort'], flow['destPort']) and \
-                   flow['protocol'] != 'ESP':
-                        # no match - ignore this flow
-                        continue
-                client = flow['sourceIp']
-                id = flow['sessionUuid']
-                if client not in filtered_sessions:
-                    filtered_sessions[client] = {}
-                filtered_sessions[client][id] = sessions[id]
-                break
-        return filtered_sessions
-
-    else:
-        retrieval_failed = True
-
-    if retrieval_failed:
-        error('Retrieving sessions table has failed: {} ({})'.format(
-              request.text, request.status_code))
-
-
-def get_stuck_sessions(filtered_sessions):
-    stuck_sessions = {}
+    for id, rows in table.sessions():
+        for row in rows:
+            if IKE_PORT not in (source_ports[row], dest_ports[row]) and \
+               protocols[row] != esp:
+                    # no match - ignore this flow
+                    continue
+            client = table.value('sourceIp', row)
+            if client not in filtered_sessions:
+                filtered_sessions[client] = {}
+            filtered_sessions[client][id] = [format_flow(flow, now) for flow in table.flows(id)]
+            break
+    return filtered_sessions
+
+
+def classify_session(flows):
+    """Classify a session as IKE or ESP in a single pass over its flows.
+
+    Return (kind, waypoint flow, last flow) - kind is 'ike', 'esp' or None.
+    The waypoint flow is the SVR flow (first non-IKE flow for IKE, first
+    UDP flow for ESP) or None. The last flow is the one, which has been
+    inspected last - the SVR details of stuck sessions are taken from it.
+    """
+    kind = None
+    non_ike = None
+    udp = None
+    flow = None
+    for flow in flows:
+        is_ike = IKE_PORT in (flow['sourcePort'], flow['destPort'])
+        if non_ike is None and not is_ike:
+            non_ike = flow
+        if udp is None and flow['protocol'] == 'UDP':
+            udp = flow
+        if kind is None:
+            if is_ike:
+                kind = 'ike'
+            elif flow['protocol'] == 'ESP':
+                kind = 'esp'
+        if kind == 'ike' and non_ike is not None:
+            return kind, non_ike, non_ike
+        if kind == 'esp' and udp is not None:
+            return kind, udp, udp
+    return kind, None, flow
+
+
+def index_clients(filtered_sessions):
+    """Index IKE and ESP sessions by client."""
+    clients = {}
+    flow = None
     for client, sessions in filtered_sessions.items():
-        esp_sessions = []
-        ike_waypoint = ''
-        esp_waypoint = ''
+        entry = clients[client] = {
+            'esp_sessions': [],
+            'ike_sessions': 0,
+            'ike_waypoint': '',
+            'esp_waypoint': '',
+        }
         for id, flows in sessions.items():
-            is_ike = False
-            is_esp = False
-            for flow in flows:
-                if IKE_PORT in (flow['sourcePort'], flow['destPort']):
-                    is_ike = True
-                    break
-                if flow['protocol'] == 'ESP':
-                    is_esp = True
-                    esp_sessions.append(id)
-                    break
+            kind, waypoint_flow, last_flow = classify_session(flows)
+            if last_flow is not None:
+                flow = last_flow
+            if kind == 'ike' and waypoint_flow is not None:
+                if entry['ike_waypoint'] != '':
+                    entry['ike_sessions'] += 1
+                entry['ike_waypoint'] = waypoint_flow['sourceIp']
+            elif kind == 'esp':
+                entry['esp_sessions'].append(id)
+                if waypoint_flow is not None:
+                    entry['esp_waypoint'] = waypoint_flow['sourceIp']
+        entry['flow'] = flow
+    return clients
 
-            if is_ike:
-                for flow in flows:
-                    if IKE_PORT not in (flow['sourcePort'], flow['destPort']):
-                        # this is the SVR flow
-                        if ike_waypoint != '':
-                            warn('Found more than one IKE session for client:',
-                                  client)
-                        ike_waypoint = flow['sourceIp']
-                        # this session is IKE, we can go ahead with next session
-                        break
-
-            if is_esp:
-                for flow in flows:
-                    if flow['protocol'] == 'UDP':
-                        # inspect SVR flow and check if waypoint differs IKE
-                        esp_waypoint = flow['sourceIp']
-                        # this session is ESP, we can go ahead with next session
-                        break
 
+def get_stuck_sessions(filtered_sessions):
+    stuck_sessions = {}
+    for client, entry in index_clients(filtered_sessions).items():
+        for _ in range(entry['ike_sessions']):
+            warn('Found more than one IKE session for client:',
+                  client)
+
+        esp_sessions = entry['esp_sessions']
+        ike_waypoint = entry['ike_waypoint']
+        esp_waypoint = entry['esp_waypoint']
         if len(esp_sessions) == 0:
             warn('No ESP sessions found for client: {}.'.format(client))
             continue
@@ -173,6 +266,8 @@ def get_stuck_sessions(filtered_sessions):
             continue
 
         if ike_waypoint != esp_waypoint:
+            # the SVR details are taken from the last inspected flow of the client
+            flow = entry['flow']
             for id in esp_sessions:
                 info('Found waypoint mismatch:', id,
                      '({} is not {})'.format(ike_waypoint, esp_waypoint))
@@ -208,8 +303,8 @@ def print_session_details(sessions):
 
 
 def dump_data(sessions):
-    dirname = '/var/log/128technology/kill-stuck-esp_{:%Y-%m-%d_%H-%M-%S}'.format(
-        datetime.now())
+    dirname = os.path.join(LOG_DIR, 'kill-stuck-esp_{:%Y-%m-%d_%H-%M-%S}'.format(
+        datetime.now()))
     os.mkdir(dirname)
     # sessions
     with open(os.path.join(dirname, 'sessions.json'), 'w') as fd:
@@ -222,6 +317,118 @@ def dump_data(sessions):
         os.path.join(dirname, 'bgp_default_route.txt')), shell=True)
 
 
+def delete_stuck_sessions(api, filtered_sessions, stuck_sessions):
+    # delete sessions on the node, where they have been found
+    nodes = {id: flows[0].get('nodeName')
+             for sessions in filtered_sessions.values()
+             for id, flows in sessions.items() if id in stuck_sessions}
+    results = api.delete_sessions(nodes)
+    failed = []
+    for id, (success, message) in results.items():
+        if not success:
+            warn('Could not delete session {}: {}'.format(id, message))
+            failed.append(id)
+    info('Deleted sessions:', len(results) - len(failed))
+    return failed
+
+
+def session_signature(flows):
+    """Return the state of a session - without the changing times."""
+    return [[flow.get(field) for field in FLOW_FIELDS + ['nodeName']
+             if field != 'startTime'] for flow in flows]
+
+
+def diff_sessions(previous, filtered_sessions):
+    """Compare filtered sessions with the state of the previous poll.
+
+    Return the new state, the clients with new, changed or removed
+    sessions and the delta (added/changed sessions, removed session ids).
+    """
+    state = {}
+    clients = set()
+    delta = {
+        'added': {},
+        'changed': {},
+        'removed': [],
+    }
+    for client, sessions in filtered_sessions.items():
+        for id, flows in sessions.items():
+            state[id] = [client, session_signature(flows)]
+            if id not in previous:
+                delta['added'][id] = flows
+            elif previous[id] != state[id]:
+                delta['changed'][id] = flows
+                clients.add(previous[id][0])
+            else:
+                continue
+            clients.add(client)
+    for id, (client, _) in previous.items():
+        if id not in state:
+            delta['removed'].append(id)
+            clients.add(client)
+    return state, clients, delta
+
+
+def append_delta_log(entry):
+    with open(DELTA_LOG, 'a') as fd:
+        fd.write(json.dumps(entry) + '\n')
+
+
+def watch(api, args):
+    """Poll sessions and act only on clients with new or changed sessions.
+
+    Each poll appends its delta to the delta log. The interval is doubled
+    (up to --max-interval), while the API fails or is slow.
+    """
+    state = {}
+    interval = args.watch
+    while True:
+        start = time.time()
+        try:
+            table = get_flow_table(api, args)
+        except (RequestException, GraphqlException, ValueError) as e:
+            interval = min(interval * 2, args.max_interval)
+            warn('Retrieving sessions table has failed:', e,
+                 '- next poll in {} seconds'.format(interval))
+        else:
+            elapsed = time.time() - start
+            info('Total number of sessions:', table.session_count())
+            if args.snapshot:
+                save_snapshot(table, args.snapshot, int(start))
+            filtered_sessions = filter_sessions(table)
+            del table
+            state, clients, delta = diff_sessions(state, filtered_sessions)
+            stuck_sessions = get_stuck_sessions(
+                {client: sessions for client, sessions in filtered_sessions.items()
+                 if client in clients})
+            entry = {key: value for key, value in delta.items() if value}
+            if stuck_sessions:
+                entry['stuck'] = list(stuck_sessions)
+            if entry:
+                entry['time'] = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.now())
+                append_delta_log(entry)
+
+            if stuck_sessions:
+                print_session_details(stuck_sessions)
+                if not args.dry_run:
+                    try:
+                        failed = delete_stuck_sessions(api, filtered_sessions, stuck_sessions)
+                    except (RequestException, GraphqlException) as e:
+                        warn('Deleting sessions has failed:', e)
+                        failed = list(stuck_sessions)
+                    # forget failed sessions - they are new and retried on the next poll
+                    for id in failed:
+                        state.pop(id, None)
+
+            if elapsed > args.watch * SLOW_POLL:
+                interval = min(interval * 2, args.max_interval)
+                info('Polling took {:.1f} seconds - next poll in {} seconds'.format(
+                     elapsed, interval))
+            else:
+                interval = args.watch
+        time.sleep(interval)
+
+
 def main():
     global info
     global warn
@@ -229,20 +436,38 @@ def main():
         pass
 
     args = parse_arguments()
+    if args.convert:
+        json_file, snapshot_file = args.convert
+        try:
+            with open(json_file) as fd:
+                table, now = sessions_to_table(json.load(fd))
+            table.save(snapshot_file, {'time': now})
+        except (OSError, ValueError, KeyError) as e:
+            error('Could not convert {}:'.format(json_file), e)
+        info('Converted {} sessions to:'.format(table.session_count()), snapshot_file)
+        return
+
     if args.print_sessions_from_file:
-        with open(args.print_sessions_from_file) as fd:
-            sessions = json.load(fd)
-            print_session_details(format_filtered_sessions(sessions))
+        sessions = load_sessions(args.print_sessions_from_file)
+        print_session_details(format_filtered_sessions(sessions))
         return
 
     if args.quiet:
         info = quiet
         warn = quiet
-    api = RestApi()
+    api = RestGraphqlApi(max_workers=args.workers)
+    if args.watch:
+        if args.test_file:
+            error('--watch cannot be used with --test-file.')
+        try:
+            watch(api, args)
+        except KeyboardInterrupt:
+            pass
+        return
+
     if args.test_file:
         # restore sessions from file and do not try to kill (--dry-run)
-        with open(args.test_file) as fd:
-            filtered_sessions = json.load(fd)
+        filtered_sessions = load_sessions(args.test_file)
         args.dry_run = True
     else:
         filtered_sessions = get_filtered_sessions(api, args)
@@ -250,7 +475,7 @@ def main():
 
     if not args.test_file:
         # do not write a new file in testing mode
-        with open('/var/log/128technology/stuck-esp-sessions.json.log', 'w') as fd:
+        with open(SESSIONS_LOG, 'w') as fd:
             json.dump(filtered_sessions, fd, indent=4)
 
     if filtered_sessions and args.print_sessions:
@@ -267,15 +492,7 @@ def main():
         if not args.dry_run:
             # write sessions and other data prior to session removal
             dump_data(filtered_sessions)
-
-            # delete session
-            for id in stuck_sessions.keys():
-                location = '/router/{}/node/{}/traffic/session?sessionId={}'.format(
-                    api.get_router_name(),
-                    api.get_node_name(),
-                    id,
-                )
-                api.delete(location)
+            delete_stuck_sessions(api, filtered_sessions, stuck_sessions)
 
 
 if __name__ == '__main__':
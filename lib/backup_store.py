@@ -0,0 +1,160 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupStore(object):
+    """Content-addressed store for config exports.
+
+    Each unique config (sha256 of the decompressed XML) is kept only once in
+    "objects/". A backup is a small pointer file in "backups/" - unchanged
+    configs cost no additional disk space. Optionally, new configs are
+    stored as line based delta against the last full config.
+    """
+
+    def __init__(self, directory, delta=False):
+        self.directory = directory
+        self.delta = delta
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.backups_dir = os.path.join(directory, 'backups')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.backups_dir, exist_ok=True)
+
+    def object_path(self, sha256, delta=False):
+        extension = '.delta.gz' if delta else '.gz'
+        return os.path.join(self.objects_dir, sha256 + extension)
+
+    def has_object(self, sha256):
+        return os.path.exists(self.object_path(sha256)) or \
+               os.path.exists(self.object_path(sha256, delta=True))
+
+    def read_pointer(self, name):
+        with open(os.path.join(self.backups_dir, name + '.json')) as fd:
+            return json.load(fd)
+
+    def write_pointer(self, pointer):
+        path = os.path.join(self.backups_dir, pointer['name'] + '.json')
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(pointer, fd)
+        os.replace(path + '.tmp', path)
+
+    def names(self):
+        """Return the names of all backups - oldest first."""
+        pointers = [self.read_pointer(f[:-5]) for f in os.listdir(self.backups_dir)
+                    if f.endswith('.json')]
+        pointers.sort(key=lambda p: (p['created'], p['name']))
+        return [p['name'] for p in pointers]
+
+    def add(self, path, name=None):
+        """Add a gzip config export and return (sha256, is new config)."""
+        if name is None:
+            name = os.path.basename(path)
+        sha256 = hashlib.sha256()
+        with gzip.open(path) as fd:
+            for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+
+        is_new = not self.has_object(sha256)
+        if is_new:
+            names = self.names()
+            base = None
+            if self.delta and names:
+                base = self.full_object(self.read_pointer(names[-1])['sha256'])
+            if not base or not self.write_delta(path, sha256, base):
+                full_path = self.object_path(sha256)
+                shutil.copyfile(path, full_path + '.tmp')
+                os.replace(full_path + '.tmp', full_path)
+
+        self.write_pointer({
+            'name': name,
+            'sha256': sha256,
+            'created': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()),
+        })
+        return sha256, is_new
+
+    def full_object(self, sha256):
+        """Return the sha256 of the full object the given object is based on."""
+        if os.path.exists(self.object_path(sha256)):
+            return sha256
+        delta_path = self.object_path(sha256, delta=True)
+        if os.path.exists(delta_path):
+            with gzip.open(delta_path) as fd:
+                return json.loads(fd.readline())['base']
+        return None
+
+    def write_delta(self, path, sha256, base):
+        """Store a config as delta to a full object - if it is smaller."""
+        with gzip.open(self.object_path(base)) as fd:
+            base_lines = fd.readlines()
+        with gzip.open(path) as fd:
+            lines = fd.readlines()
+
+        # changed lines are between the common prefix and suffix
+        prefix = 0
+        max_prefix = min(len(lines), len(base_lines))
+        while prefix < max_prefix and lines[prefix] == base_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        max_suffix = max_prefix - prefix
+        while suffix < max_suffix and lines[-1 - suffix] == base_lines[-1 - suffix]:
+            suffix += 1
+        changed = lines[prefix:len(lines) - suffix]
+
+        header = {
+            'base': base,
+            'prefix': prefix,
+            'suffix': suffix,
+        }
+        delta_path = self.object_path(sha256, delta=True)
+        with gzip.open(delta_path + '.tmp', 'wb') as fd:
+            fd.write(json.dumps(header).encode() + b'\n')
+            fd.writelines(changed)
+        if os.path.getsize(delta_path + '.tmp') * 2 > os.path.getsize(path):
+            # not worth it - store the full config instead
+            os.remove(delta_path + '.tmp')
+            return False
+        os.replace(delta_path + '.tmp', delta_path)
+        return True
+
+    def restore(self, name, path):
+        """Write the config export of a backup to path (gzip)."""
+        sha256 = self.read_pointer(name)['sha256']
+        full_path = self.object_path(sha256)
+        if os.path.exists(full_path):
+            shutil.copyfile(full_path, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            return
+
+        with gzip.open(self.object_path(sha256, delta=True)) as fd:
+            header = json.loads(fd.readline())
+            changed = fd.readlines()
+        with gzip.open(self.object_path(header['base'])) as fd:
+            base_lines = fd.readlines()
+        suffix = base_lines[len(base_lines) - header['suffix']:] if header['suffix'] else []
+        with gzip.open(path + '.tmp', 'wb') as fd:
+            fd.writelines(base_lines[:header['prefix']])
+            fd.writelines(changed)
+            fd.writelines(suffix)
+        os.replace(path + '.tmp', path)
+
+    def prune(self, max_backups):
+        """Delete all but the most recent backups and unreferenced objects."""
+        names = self.names()
+        for name in names[:max(len(names) - max_backups, 0)]:
+            os.remove(os.path.join(self.backups_dir, name + '.json'))
+
+        referenced = set()
+        for name in self.names():
+            sha256 = self.read_pointer(name)['sha256']
+            referenced.add(sha256)
+            referenced.add(self.full_object(sha256))
+        for filename in os.listdir(self.objects_dir):
+            if filename.split('.')[0] not in referenced:
+                os.remove(os.path.join(self.objects_dir, filename))
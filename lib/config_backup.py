@@ -0,0 +1,127 @@
+import datetime
+import gzip
+import os
+import sys
+import zlib
+
+from lib.backup_store import BackupStore
+from lib.rest import FileDownloadException, RestGraphqlApi
+
+
+PREFIX = 'auto-backup-'
+
+
+class BackupException(Exception):
+    pass
+
+
+def create_backup(api):
+    name = '{}{:%Y-%m-%d-%H-%M}'.format(PREFIX, datetime.datetime.now())
+    r = api.post('/config/export', {'filename': name, 'datastore': 'running'})
+    if r.status_code != 200:
+        raise BackupException('Could not create backup: {} ({})'.format(r.text, r.status_code))
+    # return the filename without the path
+    filename = r.json()['exportPath'].replace('/etc/128technology/config-exports/', '')
+    return filename
+
+
+def delete_backup(api, filename):
+    r = api.delete('/config/export/{}'.format(filename))
+
+
+def delete_old_backups(api, max_backups=3):
+    generated_backups = []
+    r = api.get('/config/export')
+    for backup in r.json():
+        name = backup['name']
+        if name.startswith(PREFIX):
+            generated_backups.append(name)
+
+    generated_backups.sort(reverse=True)
+    # delete all but <max_backups> most recent backups
+    for backup in generated_backups[max_backups:]:
+        delete_backup(api, backup)
+
+
+def verify_backup(path):
+    """Read the gzip export once to check its CRC."""
+    try:
+        with gzip.open(path) as fd:
+            while fd.read(1024 * 1024):
+                pass
+    except (OSError, EOFError, zlib.error):
+        return False
+    return True
+
+
+def download_backup(api, directory, filename):
+    # stream the file to local disk - resumes partial downloads
+    path = os.path.join(directory, filename)
+    try:
+        sha256 = api.download(f'/config/export/{filename}/download', path, nonce=True)
+    except FileDownloadException as e:
+        raise BackupException('Could not download config: {}'.format(e))
+    if not verify_backup(path):
+        os.remove(path)
+        raise BackupException('Downloaded config is corrupted: {}'.format(path))
+    print('Successfully saved config as:', path)
+    print('SHA256:', sha256)
+    return path
+
+
+def store_backup(path, directory, max_backups, delta=False):
+    """Move a downloaded backup into the store and prune old backups."""
+    store = BackupStore(directory, delta)
+    name = os.path.basename(path)
+    sha256, is_new = store.add(path, name)
+    os.remove(path)
+    if is_new:
+        print('Stored new config:', sha256)
+    else:
+        print('Config is unchanged:', sha256)
+    store.prune(max_backups)
+    return name
+
+
+def backup(args, host=None, user=None, password=None, directory=None):
+    """Create a backup and download it or remove old backups."""
+    params = {}
+    if host:
+        params['host'] = host
+        if user and password:
+            params['user'] = user
+            params['password'] = password
+    api = RestGraphqlApi(**params)
+
+    filename = create_backup(api)
+    # when the file should be downloaded, just get the file (unless --keep is given)
+    # otherwise do a cleanup
+    if args.download:
+        directory = directory or args.directory
+        path = download_backup(api, directory, filename)
+        if not args.keep:
+            delete_backup(api, filename)
+        if args.store:
+            path = store_backup(path, directory, args.max_backups, args.delta)
+        return path
+    else:
+        delete_old_backups(api, args.max_backups)
+        return filename
+
+
+def backup_process(connection, args, target):
+    """Back up one target of a fleet - runs in a spawned process.
+
+    It lives in a module (not in the script), so the process can import it,
+    also when the script is run from a zipapp.
+    """
+    # the json summary is written to stdout by the parent
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        host = target[0]
+        directory = os.path.join(args.directory, host)
+        os.makedirs(directory, exist_ok=True)
+        connection.send(('ok', backup(args, *target, directory=directory)))
+    except BaseException as e:
+        connection.send(('failed', str(e) or type(e).__name__))
+    connection.close()
@@ -0,0 +1,319 @@
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+# integer and boolean columns - all other values are interned
+INT_FIELDS = ('sourcePort', 'destPort', 'startTime')
+BOOL_FIELDS = ('encrypted', 'forward')
+NONE = -1
+BATCH_SIZE = 1024
+SNAPSHOT_MAGIC = b'T128FLOW'
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 8
+
+
+class StringTable(object):
+    """Interned values of a snapshot - each value is decoded on first access."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        value = self.cache.get(code, self)
+        if value is self:
+            value = self.cache[code] = json.loads(
+                bytes(self.data[self.offsets[code]:self.offsets[code + 1]]))
+        return value
+
+    def __iter__(self):
+        for code in range(len(self)):
+            yield self[code]
+
+
+class FlowTable(object):
+    """Flows stored column-wise.
+
+    Ports and timestamps are kept in integer arrays, all other values
+    (strings) are interned and their codes are kept in an array. When the
+    table is grouped, the rows are sorted by session (in order of their
+    first flow, flows in order of arrival) and each session maps to a range
+    of rows. Flows are only converted to dicts, when they are needed.
+    """
+
+    def __init__(self, key='sessionUuid'):
+        self.key = key
+        self.fields = []
+        self.columns = {}
+        # (field, column, interned) in order of fields
+        self.layout = []
+        self.length = 0
+        # interned values - code 0 is None
+        self.values = [None]
+        self.codes = {None: 0}
+        # code of the key of each session, rows of session i: offsets[i]..offsets[i + 1]
+        self.session_codes = array('i')
+        # session -> number, built when needed
+        self.index = None
+        self.offsets = array('q', [0])
+        self.grouped = True
+        # mapped file and its meta data, if loaded from a snapshot
+        self.snapshot = None
+        self.meta = {}
+
+    def __len__(self):
+        return self.length
+
+    def typecode(self, field):
+        if field in INT_FIELDS:
+            return 'q'
+        if field in BOOL_FIELDS:
+            return 'b'
+        return 'i'
+
+    def intern(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def code(self, value):
+        """Return the code of an interned value (None if unknown)."""
+        if self.codes is None:
+            # snapshot - all values are decoded once
+            self.codes = {v: code for code, v in enumerate(self.values)}
+        return self.codes.get(value)
+
+    def add_column(self, field):
+        typecode = self.typecode(field)
+        self.fields.append(field)
+        self.columns[field] = array(typecode, [NONE if typecode != 'i' else 0]) * self.length
+        self.layout.append((field, self.columns[field], typecode == 'i'))
+
+    def append(self, flow):
+        self.append_batch([flow])
+
+    def append_batch(self, flows):
+        """Append a list of flows - column by column."""
+        if not set().union(*flows) <= self.columns.keys():
+            # keep the order of fields
+            for flow in flows:
+                for field in flow:
+                    if field not in self.columns:
+                        self.add_column(field)
+        codes = self.codes
+        for field, column, interned in self.layout:
+            values = [flow.get(field) for flow in flows]
+            if interned:
+                found = [codes.get(value) for value in values]
+                if None in found:
+                    found = [self.intern(value) if code is None else code
+                             for code, value in zip(found, values)]
+                column.extend(found)
+            else:
+                if None in values:
+                    values = [NONE if value is None else value for value in values]
+                column.extend(values)
+        self.length += len(flows)
+        self.grouped = False
+
+    def extend(self, flows, batch_size=BATCH_SIZE):
+        batch = []
+        for flow in flows:
+            batch.append(flow)
+            if len(batch) == batch_size:
+                self.append_batch(batch)
+                batch = []
+        if batch:
+            self.append_batch(batch)
+        return self
+
+    def group(self):
+        """Sort the rows by session and build the session index."""
+        if self.grouped:
+            return
+        keys = self.columns.get(self.key, array('i', [0]) * self.length)
+        numbers = {}
+        counts = []
+        contiguous = True
+        last = number = None
+        for code in keys:
+            if code != last:
+                number = numbers.get(code)
+                if number is None:
+                    number = numbers[code] = len(counts)
+                    counts.append(0)
+                else:
+                    contiguous = False
+                last = code
+            counts[number] += 1
+
+        offsets = array('q', [0]) * (len(counts) + 1)
+        for number, count in enumerate(counts):
+            offsets[number + 1] = offsets[number] + count
+        if not contiguous:
+            # stable counting sort
+            positions = array('q', offsets[:-1])
+            order = array('q', [0]) * self.length
+            for row, code in enumerate(keys):
+                number = numbers[code]
+                order[positions[number]] = row
+                positions[number] += 1
+            for field in self.fields:
+                column = self.columns[field]
+                self.columns[field] = array(self.typecode(field), [column[row] for row in order])
+            self.layout = [(field, self.columns[field], interned)
+                           for field, _, interned in self.layout]
+
+        self.session_codes = array('i', numbers)
+        self.index = None
+        self.offsets = offsets
+        self.grouped = True
+
+    def column(self, field):
+        """Return the raw column (grouped) - codes for interned values."""
+        self.group()
+        if field not in self.columns:
+            typecode = self.typecode(field)
+            return array(typecode, [NONE if typecode != 'i' else 0]) * self.length
+        return self.columns[field]
+
+    def decode(self, field, value):
+        typecode = self.typecode(field)
+        if typecode == 'i':
+            return self.values[value]
+        if value == NONE:
+            return None
+        if typecode == 'b':
+            return bool(value)
+        return value
+
+    def value(self, field, row):
+        if field not in self.columns:
+            return None
+        return self.decode(field, self.columns[field][row])
+
+    def flow(self, row):
+        """Return a flow as dict."""
+        return {field: self.decode(field, self.columns[field][row]) for field in self.fields}
+
+    def session_count(self):
+        self.group()
+        return len(self.session_codes)
+
+    def sessions(self):
+        """Yield (session id, range of rows) - in order of the first flow."""
+        self.group()
+        offsets = self.offsets
+        values = self.values
+        for number, code in enumerate(self.session_codes):
+            yield values[code], range(offsets[number], offsets[number + 1])
+
+    def rows(self, id):
+        self.group()
+        if self.index is None:
+            self.index = {self.values[code]: number
+                          for number, code in enumerate(self.session_codes)}
+        number = self.index[id]
+        return range(self.offsets[number], self.offsets[number + 1])
+
+    def flows(self, id):
+        """Return the flows of a session as dicts."""
+        return [self.flow(row) for row in self.rows(id)]
+
+    def save(self, filename, meta=None):
+        """Write the table to a binary snapshot file.
+
+        The file consists of a json header, the columns, the interned values
+        (json encoded with an offset array) and the session index - all
+        sections are aligned, so they can be mapped without copying.
+        """
+        self.group()
+        sections = []
+        for field in self.fields:
+            sections.append(self.columns[field])
+        values = [json.dumps(value).encode() for value in self.values]
+        value_offsets = array('q', [0]) * (len(values) + 1)
+        for code, value in enumerate(values):
+            value_offsets[code + 1] = value_offsets[code] + len(value)
+        sessions = self.session_codes
+        sections += [value_offsets, b''.join(values), sessions, self.offsets]
+
+        offsets = []
+        position = 0
+        for section in sections:
+            offsets.append(position)
+            size = len(memoryview(section).cast('B'))
+            position += size + -size % ALIGNMENT
+        header = json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'byteorder': sys.byteorder,
+            'key': self.key,
+            'length': self.length,
+            'fields': [[field, self.typecode(field), offset]
+                       for field, offset in zip(self.fields, offsets)],
+            'values': offsets[-4:-2] + [len(values)],
+            'sessions': offsets[-2:] + [len(sessions)],
+            'meta': meta or {},
+        }).encode()
+        with open(filename + '.tmp', 'wb') as fd:
+            fd.write(SNAPSHOT_MAGIC + struct.pack('<I', len(header)) + header)
+            fd.write(bytes(-fd.tell() % ALIGNMENT))
+            for section in sections:
+                data = memoryview(section).cast('B')
+                fd.write(data)
+                fd.write(bytes(-len(data) % ALIGNMENT))
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Map a binary snapshot - the table is read-only."""
+        with open(filename, 'rb') as fd:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('Not a flow table snapshot: {}'.format(filename))
+        position = len(SNAPSHOT_MAGIC)
+        size, = struct.unpack_from('<I', data, position)
+        position += 4
+        header = json.loads(data[position:position + size])
+        if header['version'] != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: {}'.format(header['version']))
+        position += size
+        base = position + -position % ALIGNMENT
+        view = memoryview(data)
+
+        def section(offset, typecode, count):
+            itemsize = array(typecode).itemsize
+            start = base + offset
+            column = view[start:start + count * itemsize].cast(typecode)
+            if header['byteorder'] != sys.byteorder:
+                column = array(typecode, column)
+                column.byteswap()
+            return column
+
+        table = cls(header['key'])
+        table.snapshot = data
+        table.length = header['length']
+        for field, typecode, offset in header['fields']:
+            table.fields.append(field)
+            table.columns[field] = section(offset, typecode, table.length)
+            table.layout.append((field, table.columns[field], typecode == 'i'))
+        values_offset, strings_offset, count = header['values']
+        value_offsets = section(values_offset, 'q', count + 1)
+        table.values = StringTable(view[base + strings_offset:], value_offsets)
+        table.codes = None
+        sessions_offset, offsets_offset, count = header['sessions']
+        table.session_codes = section(sessions_offset, 'i', count)
+        table.index = None
+        table.offsets = section(offsets_offset, 'q', count + 1)
+        table.meta = header['meta']
+        return table
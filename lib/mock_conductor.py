@@ -0,0 +1,492 @@
+from base64 import b64encode
+from collections import Counter
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+from lib.quickstart import AUTHORITY_URI, SYSTEM_URI
+
+
+CONFIG_URI = 'http://128technology.com/t128'
+EXPORT_DIR = '/etc/128technology/config-exports/'
+FILE_SIZE = 1024 * 1024
+FLOWS = 1000
+NODES = 2
+ROUTERS = 10
+SERVICES = 100
+USERS = 10
+IKE_PORT = 500
+
+GRAPHQL_FIELD = re.compile(r'(?:(\w+):\s*)?(allRouters|allNodes)\s*(?:\(([^)]*)\))?')
+GRAPHQL_ARGUMENT = re.compile(r'(\w+):\s*("(?:[^"\\]|\\.)*"|\w+)')
+GRAPHQL_FLOWS = re.compile(r'flowEntries\s*\(([^)]*)\)\s*{\s*nodes\s*{([^}]*)}')
+GRAPHQL_FIELDS = re.compile(r'nodes\s*{([^{}]*)}')
+
+
+class Fleet(object):
+    """Synthetic authority with routers, nodes, services, users and flows.
+
+    All data is derived from the seed, so every run sees the same fleet.
+    Flows are generated on demand, a large flow table costs no memory.
+    """
+
+    def __init__(self, routers=ROUTERS, nodes=NODES, flows=FLOWS, services=SERVICES,
+                 users=USERS, file_size=FILE_SIZE, seed=0):
+        self.flows = flows
+        self.file_size = file_size
+        self.seed = seed
+        # the conductor comes first - like on a real conductor
+        self.routers = ['conductor'] + ['router{:04d}'.format(i) for i in range(routers)]
+        self.nodes = {}
+        for router in self.routers:
+            role = 'conductor' if router == 'conductor' else 'combo'
+            self.nodes[router] = [{'name': '{}-node{}'.format(router, i), 'role': role}
+                                  for i in range(1 if router == 'conductor' else nodes)]
+        self.node_router = {node['name']: router
+                            for router, nodes in self.nodes.items() for node in nodes}
+        rng = random.Random(seed)
+        self.services = []
+        for i in range(services):
+            addresses = ['10.{}.{}.0/24'.format(i // 256, i % 256)]
+            if rng.random() < 0.1:
+                # some overlapping prefixes
+                addresses.append('10.{}.0.0/16'.format(rng.randrange(max(services // 256, 1))))
+            self.services.append({'name': 'service{:04d}'.format(i), 'address': addresses})
+        self.users = [{
+            'name': 'admin',
+            'authenticationType': 'local',
+            'fullName': 'Administrator',
+            'roles': ['admin'],
+            'enabled': True,
+        }] + [{
+            'name': 'user{:03d}'.format(i),
+            'authenticationType': 'remote' if i % 2 else 'local',
+            'fullName': 'User {}'.format(i),
+            'roles': ['user'],
+            'enabled': True,
+        } for i in range(users)]
+        self.exports = {}
+
+    def flow(self, node, index):
+        """Return flow number index of a node.
+
+        Sessions consist of two flows. Every tenth session is IKE or ESP with
+        an SVR flow - pairs of them share a client and about half of the
+        pairs use different waypoints for IKE and ESP.
+        """
+        session = index // 2
+        rng = random.Random('{}/{}/{}'.format(self.seed, node, session))
+        kind = session % 10 if session % 20 < 2 else None
+        client = session // 2 if kind is not None else session
+        client = '192.168.{}.{}'.format(client // 250 % 250, client % 250 + 1)
+        peer = '172.16.{}.1'.format(session // 20 % 250)
+        waypoint = '100.64.0.{}'.format(rng.randrange(1, 3))
+        start = int(time.time()) - rng.randrange(86400 * 3)
+        flow = {
+            'sessionUuid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'serviceName': self.services[rng.randrange(len(self.services))]['name']
+                           if self.services else 'internet',
+            'protocol': 'TCP',
+            'sourceIp': client,
+            'sourcePort': rng.randrange(1024, 65536),
+            'destIp': peer,
+            'destPort': 443,
+            'encrypted': rng.random() < 0.5,
+            'networkInterfaceName': 'lan',
+            'forward': True,
+            'startTime': start,
+        }
+        if kind == 0:
+            flow['protocol'] = 'UDP'
+            flow['sourcePort'] = flow['destPort'] = IKE_PORT
+        elif kind == 1:
+            flow['protocol'] = 'ESP'
+            flow['sourcePort'] = flow['destPort'] = 0
+        if index % 2:
+            # reverse/SVR flow
+            flow['forward'] = False
+            flow['networkInterfaceName'] = 'wan'
+            if kind is not None:
+                flow['protocol'] = 'UDP'
+                flow['sourceIp'] = waypoint
+                flow['sourcePort'] = 16384 + session % 1000
+                flow['destPort'] = 16384 + session % 1000
+            else:
+                flow['sourceIp'], flow['destIp'] = flow['destIp'], flow['sourceIp']
+                flow['sourcePort'], flow['destPort'] = flow['destPort'], flow['sourcePort']
+        return flow
+
+    def logs(self, router, node):
+        return [{'name': 'capture-{}-{}.pcap'.format(node, i), 'type': 'pcap'}
+                for i in range(2)] + [
+                {'name': '128T_{}.log'.format(i), 'type': 'log'} for i in range(5)]
+
+    def file_content(self, name):
+        """Return deterministic content of a log file."""
+        block = hashlib.sha256(name.encode()).digest() * 32
+        repeat = self.file_size // len(block) + 1
+        return (block * repeat)[:self.file_size]
+
+    def config_xml(self):
+        lines = [
+            # same root layout as a real export - authority right below config
+            '<config xmlns="{}">'.format(CONFIG_URI),
+            '<authority xmlns="{}">'.format(AUTHORITY_URI),
+            '<name>Authority128</name>',
+        ]
+        for router in self.routers:
+            lines.append('<router><name>{}</name>'.format(router))
+            for node in self.nodes[router]:
+                lines.append('<node xmlns="{}"><name>{}</name><role>{}</role>'
+                             '<device-interface><name>wan</name></device-interface>'
+                             '<device-interface><name>lan</name></device-interface>'
+                             '</node>'.format(SYSTEM_URI, node['name'], node['role']))
+            lines.append('</router>')
+        for service in self.services:
+            lines.append('<service><name>{}</name>{}</service>'.format(
+                service['name'],
+                ''.join('<address>{}</address>'.format(a) for a in service['address'])))
+        lines.append('</authority>')
+        lines.append('</config>')
+        return '\n'.join(lines).encode()
+
+    def config_export(self):
+        return gzip.compress(self.config_xml(), mtime=0)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Request handler emulating the REST/GraphQL API of a conductor."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'mock-conductor'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_data(json.dumps(data).encode(), status, headers,
+                       content_type='application/json')
+
+    def send_data(self, data, status=200, headers=None, content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        self.send_json({'message': message}, status)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return None
+
+    def handle_request(self):
+        server = self.server
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.read_json()
+        server.count(self.command, path)
+        if server.latency:
+            time.sleep(server.latency)
+
+        if not path.startswith('/api/v1/'):
+            return self.send_error_json(404, 'Not found')
+        path = path[len('/api/v1/'):]
+
+        if path == 'login' and self.command == 'POST':
+            return self.login(body or {})
+        if not server.is_authorized(self.headers.get('Authorization', '')):
+            return self.send_error_json(401, 'Unauthorized')
+
+        for method, pattern, handler in ROUTES:
+            if method != self.command:
+                continue
+            match = re.fullmatch(pattern, path)
+            if match:
+                return handler(self, body, query, *match.groups())
+        self.send_error_json(404, 'Not found: {}'.format(path))
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+    def login(self, body):
+        if body.get('username') and (body.get('password') or body.get('local')):
+            return self.send_json({'token': self.server.new_token()})
+        self.send_error_json(400, 'Invalid username or password')
+
+    def get_routers(self, body, query):
+        self.send_json([{'name': router} for router in self.server.fleet.routers])
+
+    def get_nonce(self, body, query):
+        self.send_json({'nonce': uuid.uuid4().hex})
+
+    def get_services(self, body, query, datastore):
+        self.send_json(self.server.fleet.services)
+
+    def get_nodes(self, body, query, datastore, router):
+        if router not in self.server.fleet.nodes:
+            return self.send_error_json(404, 'Router not found')
+        self.send_json(self.server.fleet.nodes[router])
+
+    def get_device_interfaces(self, body, query, datastore, router, node):
+        if node not in self.server.fleet.node_router:
+            return self.send_error_json(404, 'Node not found')
+        self.send_json([{'name': 'wan'}, {'name': 'lan'}])
+
+    def patch_config(self, body, query, path):
+        self.send_json({})
+
+    def commit(self, body, query):
+        self.send_json({})
+
+    def get_metrics(self, body, query, router):
+        rng = random.Random('{}/{}/{}'.format(self.server.fleet.seed, router, (body or {}).get('id')))
+        now = int(time.time())
+        self.send_json([{'date': now - 900 * i, 'value': rng.randrange(1000)}
+                        for i in range(96)])
+
+    def get_logs(self, body, query, router, node):
+        self.send_json(self.server.fleet.logs(router, node))
+
+    def download_log(self, body, query, router, node):
+        if 'nonce' not in query or 'file' not in query:
+            return self.send_error_json(400, 'Missing nonce or file')
+        self.send_file(self.server.fleet.file_content(query['file']))
+
+    def delete_session(self, body, query, router, node):
+        if 'sessionId' not in query:
+            return self.send_error_json(400, 'Missing sessionId')
+        self.send_json({})
+
+    def create_export(self, body, query):
+        name = (body or {}).get('filename') or 'export'
+        name += '.gz'
+        self.server.fleet.exports[name] = self.server.fleet.config_export()
+        self.send_json({'exportPath': EXPORT_DIR + name})
+
+    def get_exports(self, body, query):
+        self.send_json([{'name': name} for name in sorted(self.server.fleet.exports)])
+
+    def delete_export(self, body, query, name):
+        if self.server.fleet.exports.pop(name, None) is None:
+            return self.send_error_json(404, 'Export not found')
+        self.send_data(b'', 204)
+
+    def download_export(self, body, query, name):
+        if name not in self.server.fleet.exports:
+            return self.send_error_json(404, 'Export not found')
+        if 'nonce' not in query:
+            return self.send_error_json(400, 'Missing nonce')
+        self.send_file(self.server.fleet.exports[name])
+
+    def send_file(self, data):
+        """Send a file - supports "Range: bytes=<offset>-"."""
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Digest': 'sha-256=' + b64encode(hashlib.sha256(data).digest()).decode(),
+        }
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if not match:
+            return self.send_data(data, headers=headers)
+        offset = int(match.group(1))
+        if offset >= len(data):
+            headers['Content-Range'] = 'bytes */{}'.format(len(data))
+            return self.send_data(b'', 416, headers)
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(offset, len(data) - 1, len(data))
+        self.send_data(data[offset:], 206, headers)
+
+    def get_users(self, body, query):
+        self.send_json(self.server.fleet.users)
+
+    def add_user(self, body, query):
+        self.send_json(body or {}, 201)
+
+    def update_user(self, body, query, name):
+        self.send_json(body or {})
+
+    def delete_user(self, body, query, name):
+        self.send_data(b'', 204)
+
+    def graphql(self, body, query):
+        try:
+            data = self.server.graphql((body or {}).get('query', ''))
+        except ValueError as e:
+            return self.send_json({'errors': [{'message': str(e)}]})
+        self.send_json({'data': data})
+
+
+ROUTES = (
+    ('GET', r'router', Handler.get_routers),
+    ('GET', r'nonce', Handler.get_nonce),
+    ('GET', r'config/(running|candidate)/authority/service', Handler.get_services),
+    ('GET', r'config/(running|candidate)/authority/router/([^/]+)/node', Handler.get_nodes),
+    ('GET', r'config/(running|candidate)/authority/router/([^/]+)/node/([^/]+)/device-interface',
+     Handler.get_device_interfaces),
+    ('PATCH', r'config/candidate/(.+)', Handler.patch_config),
+    ('POST', r'config/commit', Handler.commit),
+    ('POST', r'router/([^/]+)/metrics', Handler.get_metrics),
+    ('GET', r'router/([^/]+)/node/([^/]+)/logs/collapsed', Handler.get_logs),
+    ('GET', r'router/([^/]+)/node/([^/]+)/logs/collapsed/download', Handler.download_log),
+    ('DELETE', r'router/([^/]+)/node/([^/]+)/traffic/session', Handler.delete_session),
+    ('POST', r'config/export', Handler.create_export),
+    ('GET', r'config/export', Handler.get_exports),
+    ('DELETE', r'config/export/([^/]+)', Handler.delete_export),
+    ('GET', r'config/export/([^/]+)/download', Handler.download_export),
+    ('GET', r'user', Handler.get_users),
+    ('POST', r'user', Handler.add_user),
+    ('PATCH', r'user/([^/]+)', Handler.update_user),
+    ('DELETE', r'user/([^/]+)', Handler.delete_user),
+    ('POST', r'graphql', Handler.graphql),
+)
+
+
+class MockConductor(ThreadingHTTPServer):
+    """HTTPS server emulating a conductor for offline tests and benchmarks.
+
+    latency is added to each request (in seconds), tokens expire after
+    token_lifetime seconds (if given). Requests are counted per endpoint.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, fleet, host='localhost', port=443, latency=0, token_lifetime=None,
+                 certfile=None, keyfile=None, verbose=False):
+        super().__init__((host, port), Handler)
+        self.fleet = fleet
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.verbose = verbose
+        self.tokens = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                certfile, keyfile = create_certificate(directory)
+                context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return host if port == 443 else '{}:{}'.format(host, port)
+
+    def count(self, method, path):
+        # group requests by endpoint - without router/node/file names
+        endpoint = re.sub(r'/(router|node|export|user|device-interface)/[^/]+',
+                          r'/\1/*', path)
+        with self.lock:
+            self.requests[method + ' ' + endpoint] += 1
+
+    def reset(self):
+        with self.lock:
+            requests = self.requests
+            self.requests = Counter()
+        return requests
+
+    def new_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time()
+        return token
+
+    def is_authorized(self, authorization):
+        token = authorization[len('Bearer '):]
+        with self.lock:
+            created = self.tokens.get(token)
+        if created is None:
+            return False
+        return not self.token_lifetime or time.time() - created < self.token_lifetime
+
+    def graphql(self, query):
+        """Answer the GraphQL queries used by the scripts."""
+        data = {}
+        for match in GRAPHQL_FIELD.finditer(query):
+            alias, field, arguments = match.groups()
+            arguments = {k: json.loads(v) if v.startswith('"') else v
+                         for k, v in GRAPHQL_ARGUMENT.findall(arguments or '')}
+            # the selection ends before the next top level field
+            next_field = GRAPHQL_FIELD.search(query, match.end())
+            selection = query[match.end():next_field.start() if next_field else len(query)]
+            if field == 'allRouters':
+                data[alias or field] = self.graphql_routers(arguments, selection)
+            else:
+                data[alias or field] = self.graphql_nodes(arguments, selection)
+        if not data:
+            raise ValueError('Unsupported query')
+        return data
+
+    def graphql_routers(self, arguments, selection):
+        fields = GRAPHQL_FIELDS.findall(selection)[-1].split()
+        routers = self.fleet.routers
+        if 'name' in arguments:
+            routers = [r for r in routers if r == arguments['name']]
+        return {'nodes': [{'name': router, 'nodes': {'nodes': [
+            {k: v for k, v in node.items() if k in fields}
+            for node in self.fleet.nodes[router]]}} for router in routers]}
+
+    def graphql_nodes(self, arguments, selection):
+        if 'name' in arguments:
+            nodes = [arguments['name']] if arguments['name'] in self.fleet.node_router else []
+        else:
+            # the local router - the first one
+            nodes = [node['name'] for node in self.fleet.nodes[self.fleet.routers[0]]]
+        flows = GRAPHQL_FLOWS.search(selection)
+        if not flows:
+            return {'nodes': [{'name': node} for node in nodes]}
+
+        flow_arguments = {k: json.loads(v) if v.startswith('"') else v
+                          for k, v in GRAPHQL_ARGUMENT.findall(flows.group(1))}
+        fields = flows.group(2).split()
+        first = int(flow_arguments.get('first', self.fleet.flows))
+        offset = int(flow_arguments.get('after', 0))
+        end = min(offset + first, self.fleet.flows)
+        result = []
+        for node in nodes:
+            entries = []
+            for index in range(offset, end):
+                flow = self.fleet.flow(node, index)
+                entries.append({field: flow.get(field) for field in fields})
+            result.append({'name': node, 'flowEntries': {
+                'nodes': entries,
+                'pageInfo': {
+                    'endCursor': str(end),
+                    'hasNextPage': end < self.fleet.flows,
+                },
+            }})
+        return {'nodes': result}
+
+
+def create_certificate(directory):
+    """Create a self-signed certificate with openssl."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-subj', '/CN=localhost', '-days', '1',
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
@@ -1,12 +1,25 @@
 from base64 import b64decode, b64encode
 import gzip
+import io
 import json
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
+import zlib
+
+
+AUTHORITY_URI = 'http://128technology.com/t128/config/authority-config'
+SYSTEM_URI = 'http://128technology.com/t128/config/system-config'
+AUTHORITY_NS = '{' + AUTHORITY_URI + '}'
+SYSTEM_NS = '{' + SYSTEM_URI + '}'
+CHUNK_SIZE = 1024 * 1024
 
 
 class Quickstart(object):
     """Class to create/manipulate quickstart files."""
     xml_config = ''
+    # config as list of bytes-like parts (e.g. views into a shared export)
+    xml_parts = None
+    export_file = None
     asset_id = None
     router_name = 'generic-quickstart-router'
     node_name = 'node'
@@ -18,26 +31,149 @@ class Quickstart(object):
     def update_xml_config(self, filename):
         with open(filename) as fd:
             self.xml_config = fd.read()
+        self.xml_parts = None
+        self.export_file = None
 
-    def read_config_export(self, filename):
-        with gzip.open(filename, mode='rt') as fd:
-            self.xml_config = fd.read()
+    def read_config_export(self, filename, router_name=None):
+        """Get router and node name from a config export.
 
-            ns = {'authy': 'http://128technology.com/t128/config/authority-config',
-                  'sys': 'http://128technology.com/t128/config/system-config'}
-            root = ET.fromstring(self.xml_config)
-            for authority in root.findall('authy:authority', ns):
-                for router in authority.findall('authy:router', ns):
-                    name = router.find('authy:name', ns)
-                    self.router_name = name.text
-                    for node in router.findall('sys:node', ns):
-                        name = node.find('sys:name', ns)
-                        self.node_name = name.text
+        The last router of the authority (or the router router_name) and its
+        last node are used. The export is parsed incrementally - the config
+        itself is streamed from the file when it is written.
+        """
+        self.export_file = filename
+        self.xml_config = ''
+        self.xml_parts = None
+        authority = AUTHORITY_NS + 'authority'
+        router = AUTHORITY_NS + 'router'
+        node = SYSTEM_NS + 'node'
+        found = False
+        with gzip.open(filename) as fd:
+            path = []
+            current = None
+            for event, element in ET.iterparse(fd, events=('start', 'end')):
+                if event == 'start':
+                    path.append(element.tag)
+                    continue
+                path.pop()
+                # authority is expected directly below the root element
+                parents = path[1:]
+                selected = router_name is None or current == router_name
+                if element.tag == AUTHORITY_NS + 'name' and parents == [authority, router]:
+                    current = element.text
+                    if router_name is None or current == router_name:
+                        self.router_name = current
+                        found = True
+                elif element.tag == SYSTEM_NS + 'name' and \
+                     parents == [authority, router, node] and selected:
+                    self.node_name = element.text
+                elif element.tag == router and parents == [authority]:
+                    if router_name is not None and current == router_name:
+                        break
+                    current = None
+                element.clear()
+        if router_name is not None and not found:
+            raise ValueError('Router not found in config export: {}'.format(router_name))
 
-    def to_bytes(self):
-        quickstart = {
+    def iter_xml_config(self):
+        """Yield the xml config in chunks."""
+        if self.export_file:
+            with gzip.open(self.export_file) as fd:
+                yield from iter(lambda: fd.read(CHUNK_SIZE), b'')
+        elif self.xml_parts is not None:
+            yield from self.xml_parts
+        elif isinstance(self.xml_config, bytes):
+            yield self.xml_config
+        else:
+            yield bytes(self.xml_config, 'ascii')
+
+    def write(self, fd):
+        """Write the quickstart to a binary file object.
+
+        The config is gzip compressed and base64 encoded on the fly.
+        """
+        header = json.dumps({
             'n': self.node_name,
             'a': self.asset_id,
-            'c': b64encode(gzip.compress(bytes(self.xml_config, 'ascii'))).decode('ascii'),
-        }
-        return bytes(json.dumps(quickstart), 'ascii')
+            'c': '',
+        })
+        # the config is the last value - strip the closing '"}'
+        fd.write(bytes(header[:-2], 'ascii'))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        remainder = b''
+        for chunk in self.iter_xml_config():
+            data = remainder + compressor.compress(chunk)
+            # encode complete 3 byte groups only, so no padding is inserted
+            end = len(data) - len(data) % 3
+            fd.write(b64encode(data[:end]))
+            remainder = data[end:]
+        fd.write(b64encode(remainder + compressor.flush()))
+        fd.write(b'"}')
+
+    def to_bytes(self):
+        fd = io.BytesIO()
+        self.write(fd)
+        return fd.getvalue()
+
+
+def split_config_export(filename):
+    """Split an authority config export into one quickstart per router node.
+
+    The export is decompressed and parsed only once. Each quickstart contains
+    the authority config with all other routers removed - its parts are
+    views into the shared export, the config is only put together when the
+    quickstart is written. Quickstarts are yielded in order of the export.
+    """
+    with gzip.open(filename) as fd:
+        data = fd.read()
+
+    # find byte ranges, names and node names of all routers
+    authority = AUTHORITY_URI + 'authority'
+    router = AUTHORITY_URI + 'router'
+    router_name = AUTHORITY_URI + 'name'
+    node = SYSTEM_URI + 'node'
+    node_name = SYSTEM_URI + 'name'
+    routers = []
+    path = []
+    text = []
+    parser = expat.ParserCreate(namespace_separator='')
+
+    def start(tag, attributes):
+        path.append(tag)
+        text.clear()
+        if path[1:] == [authority, router]:
+            routers.append({
+                'start': parser.CurrentByteIndex,
+                'name': None,
+                'nodes': [],
+            })
+
+    def end(tag):
+        if path[1:] == [authority, router, router_name]:
+            routers[-1]['name'] = ''.join(text)
+        elif path[1:] == [authority, router, node, node_name]:
+            routers[-1]['nodes'].append(''.join(text))
+        elif path[1:] == [authority, router]:
+            routers[-1]['end'] = data.index(b'>', parser.CurrentByteIndex) + 1
+        path.pop()
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.Parse(data, True)
+    if not routers:
+        return
+
+    # authority config without any router - routers are inserted at the first one
+    view = memoryview(data)
+    head = view[:routers[0]['start']]
+    tail = [view[a['end']:b['start']] for a, b in zip(routers, routers[1:])]
+    tail.append(view[routers[-1]['end']:])
+    for r in routers:
+        parts = [head, view[r['start']:r['end']]] + tail
+        for name in r['nodes'] or [Quickstart.node_name]:
+            quickstart = Quickstart()
+            quickstart.xml_parts = parts
+            quickstart.router_name = r['name']
+            quickstart.node_name = name
+            yield quickstart
@@ -1,7 +1,22 @@
+from base64 import b64decode
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hashlib
+import json
 import os
 import pathlib
+import queue
+import re
 import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+import socket
+import tempfile
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import InsecureRequestWarning, ReadTimeoutError
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
@@ -9,6 +24,322 @@ class UnauthorizedException(Exception):
     pass
 
 
+class GraphqlException(Exception):
+    pass
+
+
+class MissingNonceException(Exception):
+    pass
+
+
+class FileDownloadException(Exception):
+    pass
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters, which can follow a complete number
+NUMBER_END = ' \t\n\r,]}'
+CHUNK_SIZE = 64 * 1024
+FLOW_ENTRIES = 'data.allNodes.nodes.item.flowEntries.nodes.item'
+FLOW_PAGE_INFO = 'data.allNodes.nodes.item.flowEntries.pageInfo'
+FLOW_PAGE_SIZE = 1000
+FLOW_QUERY = '''
+{{
+  allNodes(name: {node}) {{
+    nodes {{
+      flowEntries(first: {first}{after}) {{
+        nodes {{
+          {fields}
+        }}
+        pageInfo {{
+          endCursor
+          hasNextPage
+        }}
+      }}
+    }}
+  }}
+}}
+'''
+NODE_NAMES = 'data.allNodes.nodes.item.name'
+MAX_WORKERS = 8
+GRAPHQL_BATCH_SIZE = 100
+GRAPHQL_MAX_LENGTH = 64 * 1024
+# seconds to cache GET responses per location (regular expression)
+CACHE_TTLS = (
+    (r'^router$', 60),
+    (r'^config/running/', 300),
+)
+
+
+def iter_json_items(chunks, *prefixes):
+    """Parse a JSON document incrementally from an iterable of byte chunks.
+
+    Yields (prefix, value) for every value whose path matches one of the
+    dotted prefixes - array elements are addressed as "item". Values outside
+    of the requested paths are skipped, so only one matching value at a time
+    has to be held in memory.
+    """
+    targets = {tuple(p.split('.')) for p in prefixes}
+    ancestors = {t[:i] for t in targets for i in range(len(t))}
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    eof = False
+    need_more = False
+    # one entry per open container: True for objects, False for arrays
+    stack = []
+    path = []
+    expect = 'value'
+
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if need_more or pos >= len(buffer):
+            if eof:
+                if stack or expect == 'value':
+                    raise ValueError('Unexpected end of JSON stream')
+                return
+            # drop consumed data and read the next chunk
+            buffer = buffer[pos:]
+            pos = 0
+            try:
+                buffer += text.decode(next(chunks))
+            except StopIteration:
+                buffer += text.decode(b'', final=True)
+                eof = True
+            need_more = False
+            continue
+
+        c = buffer[pos]
+        if expect == 'value':
+            current = tuple(path)
+            if c == ']' and stack and not stack[-1]:
+                # empty array
+                expect = 'next'
+            elif c in '{[' and current in ancestors:
+                is_object = c == '{'
+                stack.append(is_object)
+                path.append(None if is_object else 'item')
+                expect = 'key' if is_object else 'value'
+                pos += 1
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    need_more = True
+                    continue
+                if not eof and (end == len(buffer) or
+                                c in '-0123456789' and buffer[end] not in NUMBER_END):
+                    # a number might continue in the next chunk (e.g. "1." + "5")
+                    need_more = True
+                    continue
+                pos = end
+                if current in targets:
+                    yield '.'.join(current), value
+                expect = 'next' if stack else 'done'
+        elif expect == 'key':
+            if c == '}':
+                expect = 'next'
+                continue
+            try:
+                key, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                need_more = True
+                continue
+            colon = WHITESPACE.match(buffer, end).end()
+            if colon >= len(buffer):
+                need_more = True
+                continue
+            if buffer[colon] != ':':
+                raise ValueError('Expected ":" at position {}'.format(colon))
+            path[-1] = key
+            pos = colon + 1
+            expect = 'value'
+        elif expect == 'next':
+            pos += 1
+            if c == ',':
+                expect = 'key' if stack[-1] else 'value'
+            elif c in '}]':
+                stack.pop()
+                path.pop()
+                expect = 'next' if stack else 'done'
+            else:
+                raise ValueError('Unexpected "{}" at position {}'.format(c, pos - 1))
+        else:
+            raise ValueError('Extra data at position {}'.format(pos))
+
+
+def write_token_file(token_file, token):
+    """Write the token atomically - serialized by a lock file across processes."""
+    with open(token_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(token_file),
+                                        prefix=os.path.basename(token_file))
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(token)
+            os.replace(tmp_file, token_file)
+        except:
+            os.remove(tmp_file)
+            raise
+
+
+class GraphqlBatch(object):
+    """Combine many selections (e.g. one per router) into few GraphQL queries.
+
+    Each selection gets an alias, the documents are split into chunks of at
+    most max_selections selections and max_length characters.
+    """
+
+    def __init__(self, max_selections=GRAPHQL_BATCH_SIZE, max_length=GRAPHQL_MAX_LENGTH):
+        self.max_selections = max_selections
+        self.max_length = max_length
+        self.selections = []
+
+    def add(self, key, field, selection, **arguments):
+        """Add a selection - its result is returned for key."""
+        if arguments:
+            field += '({})'.format(', '.join(
+                '{}: {}'.format(k, json.dumps(v)) for k, v in arguments.items()))
+        self.selections.append((key, '{} {{ {} }}'.format(field, selection)))
+
+    def documents(self):
+        """Return a list of (query, {alias: key})."""
+        documents = []
+        aliases = {}
+        parts = []
+        length = 0
+        for index, (key, selection) in enumerate(self.selections):
+            alias = 'q{}'.format(index)
+            part = '{}: {}'.format(alias, selection)
+            if parts and (len(parts) >= self.max_selections or
+                          length + len(part) > self.max_length):
+                documents.append(('{{ {} }}'.format(' '.join(parts)), aliases))
+                aliases = {}
+                parts = []
+                length = 0
+            aliases[alias] = key
+            parts.append(part)
+            length += len(part)
+        if parts:
+            documents.append(('{{ {} }}'.format(' '.join(parts)), aliases))
+        return documents
+
+
+class ResponseCache(object):
+    """Cache for GET responses with per-location TTL and ETag revalidation."""
+
+    def __init__(self, ttls=CACHE_TTLS, filename=None):
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def ttl(self, location):
+        """Return the TTL for a location or None if it should not be cached."""
+        for pattern, ttl in self.ttls:
+            if pattern.search(location):
+                return ttl
+        return None
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, response):
+        with self.lock:
+            self.entries[url] = {
+                'time': time.time(),
+                'etag': response.headers.get('ETag'),
+                'content_type': response.headers.get('Content-Type'),
+                'content': response.text,
+            }
+            self.save()
+
+    def touch(self, url):
+        with self.lock:
+            self.entries[url]['time'] = time.time()
+            self.save()
+
+    def invalidate(self):
+        with self.lock:
+            if self.entries:
+                self.entries = {}
+                self.save()
+
+    @staticmethod
+    def response(entry, url):
+        """Create a response object from a cache entry."""
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.encoding = 'utf-8'
+        r._content = entry['content'].encode('utf-8')
+        if entry.get('etag'):
+            r.headers['ETag'] = entry['etag']
+        if entry.get('content_type'):
+            r.headers['Content-Type'] = entry['content_type']
+        return r
+
+    def load(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename) as fd:
+                self.entries = json.load(fd)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_file = self.filename + '.tmp'
+        try:
+            with open(tmp_file, 'w') as fd:
+                json.dump(self.entries, fd)
+            os.replace(tmp_file, self.filename)
+        except OSError:
+            pass
+
+
+class PoolAdapter(HTTPAdapter):
+    """HTTP adapter with TCP keep-alive and connection statistics."""
+
+    def __init__(self, keep_alive=True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            socket_options = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+            kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self):
+        """Return number of requests, new connections and pool hits."""
+        num_requests = num_connections = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return {
+            'requests': num_requests,
+            'new_connections': num_connections,
+            'pool_hits': max(num_requests - num_connections, 0),
+        }
+
+
 class RestGraphqlApi(object):
     """Representation of REST connection."""
 
@@ -18,24 +349,49 @@ class RestGraphqlApi(object):
         'Content-Type': 'application/json',
     }
 
-    def __init__(self, host='localhost', verify=False, user='admin', password=None, app=__file__):
+    def __init__(self, host='localhost', verify=False, user='admin', password=None, app=__file__,
+                 max_workers=MAX_WORKERS, pool_size=None, max_retries=0, backoff_factor=0.5,
+                 keep_alive=True, cache=False, cache_ttls=CACHE_TTLS):
         self.host = host
         self.verify = verify
         self.user = user
         self.password = password
+        self.max_workers = max_workers
         basename = os.path.basename(app).split('.')[0]
         self.user_agent = basename
         self.token_file = os.path.join(
              pathlib.Path.home(), '.{}.token'.format(basename))
         self.read_token()
+        # cache GET responses in memory or additionally on disk
+        self.cache = None
+        if cache:
+            cache_file = None
+            if cache == 'disk':
+                cache_file = os.path.join(
+                    pathlib.Path.home(), '.{}.cache'.format(basename))
+            self.cache = ResponseCache(cache_ttls, cache_file)
+        # do not modify the class attribute - it is shared by all instances
+        self.headers = dict(self.headers)
         self.headers.update({
              'User-Agent': self.user_agent,
              'Authorization': f'Bearer {self.token}',
         })
+        self.login_lock = threading.RLock()
 
         self.session = requests.Session()
         self.session.headers.update(self.headers)
         self.session.hooks['response'].append(self.refresh_token)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        # keep (at least) one connection per worker alive
+        # like requests' default, read errors are not retried - a read timeout
+        # stays a ReadTimeout instead of becoming a ConnectionError
+        retries = Retry(total=max_retries, read=False, backoff_factor=backoff_factor,
+                        status_forcelist=(502, 503, 504), raise_on_status=False)
+        self.adapter = PoolAdapter(keep_alive=keep_alive,
+                                   pool_maxsize=pool_size or max(max_workers, 10),
+                                   max_retries=retries)
+        self.session.mount('https://', self.adapter)
         self.max_login_attempts = 3
         self.remaining_login_attempts = self.max_login_attempts
         self.connection_timeout = 3
@@ -49,54 +405,108 @@ class RestGraphqlApi(object):
             pass
 
     def write_token(self):
-        try:
-            with open(self.token_file, 'w') as fd:
-                fd.write(self.token)
-        except:
-            raise
+        write_token_file(self.token_file, self.token)
 
     def refresh_token(self, r, *args, **kwargs):
         if r.status_code == 401:
-            if self.remaining_login_attempts:
-                self.remaining_login_attempts -= 1
-                token = self.login()
-                self.session.headers.update({'Authorization': f'Bearer {token}'})
-                r.request.headers['Authorization'] = self.session.headers['Authorization']
-                return self.session.send(r.request, verify=self.verify)
-            else:
-                UnauthorizedException(r.json().get('message'))
-        else:
+            if r.request.path_url.endswith('/login'):
+                return
+            expired = r.request.headers.get('Authorization')
+            # only the first request with an expired token logs in again,
+            # all others wait for the lock and use the new token
+            with self.login_lock:
+                if self.session.headers.get('Authorization') == expired:
+                    if not self.remaining_login_attempts:
+                        return
+                    self.remaining_login_attempts -= 1
+                    token = self.login()
+                    self.session.headers.update({'Authorization': f'Bearer {token}'})
+                authorization = self.session.headers['Authorization']
+            # read the response, so its connection is returned to the pool
+            r.content
+            r.close()
+            request = r.request.copy()
+            request.headers['Authorization'] = authorization
+            return self.session.send(request, **kwargs)
+        elif self.remaining_login_attempts != self.max_login_attempts:
             # reset login counter
-            self.remaining_login_attempts = self.max_login_attempts
+            with self.login_lock:
+                self.remaining_login_attempts = self.max_login_attempts
 
-    def get(self, location, authorization_required=True):
+    def get(self, location, authorization_required=True, **kwargs):
         """Get data per REST API."""
         url = 'https://{}/api/v1/{}'.format(self.host, location.strip('/'))
+        if self.cache and not kwargs:
+            ttl = self.cache.ttl(location.strip('/'))
+            if ttl is not None:
+                return self.cached_get(url, ttl)
+        kwargs.setdefault('timeout', (self.connection_timeout, self.read_timeout))
+        request = self.session.get(url, verify=self.verify, **kwargs)
+        return request
+
+    def cached_get(self, url, ttl):
+        """Get data from cache - revalidate expired entries by their ETag."""
+        entry = self.cache.get(url)
+        headers = {}
+        if entry:
+            if time.time() - entry['time'] < ttl:
+                return self.cache.response(entry, url)
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
         timeout = (self.connection_timeout, self.read_timeout)
-        request = self.session.get(url, timeout=timeout, verify=self.verify)
+        request = self.session.get(url, verify=self.verify, headers=headers, timeout=timeout)
+        if request.status_code == 304 and entry:
+            self.cache.touch(url)
+            return self.cache.response(entry, url)
+        if request.status_code == 200:
+            self.cache.put(url, request)
         return request
 
-    def post(self, location, json, authorization_required=True):
+    def invalidate_cache(self, location):
+        """Drop cached responses when the config is changed."""
+        if self.cache and location.strip('/').startswith(('config/candidate', 'config/commit')):
+            self.cache.invalidate()
+
+    def post(self, location, json, authorization_required=True, **kwargs):
         """Send data per REST API via post."""
         url = 'https://{}/api/v1/{}'.format(self.host, location.strip('/'))
-        timeout = (self.connection_timeout, self.read_timeout)
-        request = self.session.post(url, json=json, timeout=timeout, verify=self.verify)
+        kwargs.setdefault('timeout', (self.connection_timeout, self.read_timeout))
+        request = self.session.post(url, json=json, verify=self.verify, **kwargs)
+        self.invalidate_cache(location)
         return request
 
-    def patch(self, location, json, authorization_required=True):
+    def patch(self, location, json, authorization_required=True, **kwargs):
         """Send data per REST API via patch."""
         url = 'https://{}/api/v1/{}'.format(self.host, location.strip('/'))
-        timeout = (self.connection_timeout, self.read_timeout)
-        request = self.session.patch(url, json=json, timeout=timeout, verify=self.verify)
+        kwargs.setdefault('timeout', (self.connection_timeout, self.read_timeout))
+        request = self.session.patch(url, json=json, verify=self.verify, **kwargs)
+        self.invalidate_cache(location)
         return request
 
-    def delete(self, location, authorization_required=True):
+    def delete(self, location, authorization_required=True, **kwargs):
         """Delete object per REST API."""
         url = 'https://{}/api/v1/{}'.format(self.host, location.strip('/'))
-        timeout = (self.connection_timeout, self.read_timeout)
-        request = self.session.delete(url, timeout=timeout, verify=self.verify)
+        kwargs.setdefault('timeout', (self.connection_timeout, self.read_timeout))
+        request = self.session.delete(url, verify=self.verify, **kwargs)
+        self.invalidate_cache(location)
         return request
 
+    def connection_stats(self):
+        """Return counters to size the connection pool."""
+        return self.adapter.stats()
+
+    def map(self, func, items, max_workers=None):
+        """Call func for all items with at most max_workers concurrent calls.
+
+        The results are returned as list in the order of items.
+        """
+        items = list(items)
+        max_workers = max_workers or self.max_workers
+        if max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, items))
+
     def login(self):
         json = {
             'username': self.user,
@@ -135,6 +545,11 @@ class RestGraphqlApi(object):
         return self.get('/config/running/authority/router/{}/node'.format(
             router)).json()
 
+    def get_node_name(self, router=None):
+        request = self.get('/router/{}/node'.format(router or self.router_name))
+        self.node_name = request.json()[0]['name']
+        return self.node_name
+
     def get_node_names(self, router):
         nodes = self.get_nodes(router)
         node_names = [node['name'] for node in nodes]
@@ -144,5 +559,243 @@ class RestGraphqlApi(object):
         return self.get(('/config/running/authority/router/{}/node/{}'
                          '/device-interface').format(router, node)).json()
 
+    def get_nonce(self):
+        r = self.get('/nonce')
+        if r.status_code == 200:
+            nonce = r.json()['nonce']
+            return nonce
+        else:
+            raise MissingNonceException('Could not retrieve a nonce.')
+
+    def download(self, location, path, nonce=False, attempts=3, chunk_size=CHUNK_SIZE):
+        """Download a file to path and return its sha256 hex digest.
+
+        The data is streamed to "<path>.part", which is renamed when the size
+        (and checksum, if the server sends a Digest header) has been verified.
+        Interrupted downloads are resumed with HTTP Range requests, if the
+        server supports them - also from an earlier run.
+        """
+        partial_path = path + '.part'
+        total = None
+        expected_digest = None
+        for attempt in range(1, attempts + 1):
+            offset = 0
+            if os.path.exists(partial_path):
+                offset = os.path.getsize(partial_path)
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            try:
+                # a new nonce for each attempt - its retrieval can fail as well
+                params = {'nonce': self.get_nonce()} if nonce else None
+                with self.get(location, stream=True, headers=headers, params=params) as r:
+                    content_range = r.headers.get('Content-Range', '')
+                    if '/' in content_range and content_range[-1] != '*':
+                        total = int(content_range.rsplit('/', 1)[1])
+                    if r.status_code == 416:
+                        if total != offset:
+                            # the partial file does not match - start over
+                            os.remove(partial_path)
+                            continue
+                        break
+                    if r.status_code == 206:
+                        mode = 'ab'
+                    elif r.status_code == 200:
+                        # no range support - download the whole file
+                        mode = 'wb'
+                        total = None
+                        if 'Content-Length' in r.headers and \
+                           'Content-Encoding' not in r.headers:
+                            total = int(r.headers['Content-Length'])
+                    else:
+                        raise FileDownloadException('Could not download: {} ({})'.format(
+                            r.text, r.status_code))
+                    digest = r.headers.get('Digest', '')
+                    if digest.lower().startswith('sha-256='):
+                        expected_digest = b64decode(digest[8:]).hex()
+                    with open(partial_path, mode) as fd:
+                        for chunk in r.iter_content(chunk_size):
+                            fd.write(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, MissingNonceException) as e:
+                if attempt == attempts:
+                    raise FileDownloadException(
+                        'Download was interrupted {} times: {}'.format(attempts, e))
+
+        size = os.path.getsize(partial_path)
+        if total is not None and size != total:
+            if size > total:
+                os.remove(partial_path)
+            raise FileDownloadException('Downloaded {} bytes instead of {}'.format(size, total))
+        sha256 = hashlib.sha256()
+        with open(partial_path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(chunk_size), b''):
+                sha256.update(chunk)
+        if expected_digest and sha256.hexdigest() != expected_digest:
+            os.remove(partial_path)
+            raise FileDownloadException('Checksum mismatch for: {}'.format(path))
+        os.replace(partial_path, path)
+        return sha256.hexdigest()
+
+    def query_batch(self, batch, **kwargs):
+        """Run all queries of a GraphqlBatch and return {key: result}."""
+        def run(document):
+            query, aliases = document
+            request = self.post('/graphql', {'query': query}, **kwargs)
+            if request.status_code != 200:
+                raise GraphqlException('{} ({})'.format(
+                    request.text, request.status_code))
+            response = request.json()
+            data = response.get('data')
+            if data is None:
+                raise GraphqlException('; '.join(
+                    e.get('message', str(e)) for e in response.get('errors', [])))
+            return {key: data.get(alias) for alias, key in aliases.items()}
+
+        results = {}
+        for result in self.map(run, batch.documents()):
+            results.update(result)
+        return results
+
+    def get_router_nodes(self, routers, fields=('name', 'role')):
+        """Return {router: [nodes]} for many routers with few GraphQL queries."""
+        batch = GraphqlBatch()
+        for router in routers:
+            batch.add(router, 'allRouters', 'nodes {{ nodes {{ nodes {{ {} }} }} }}'.format(
+                ' '.join(fields)), name=router)
+        results = self.query_batch(batch)
+        return {router: [node for r in (results.get(router) or {}).get('nodes', [])
+                         for node in r['nodes']['nodes']]
+                for router in routers}
+
+    def iter_graphql(self, query, *prefixes, **kwargs):
+        """Post a GraphQL query and yield matching values while streaming."""
+        request = self.post('/graphql', {'query': query}, stream=True, **kwargs)
+        with request:
+            if request.status_code != 200:
+                raise GraphqlException('{} ({})'.format(
+                    request.text, request.status_code))
+            errors = []
+            found = False
+            try:
+                chunks = request.iter_content(CHUNK_SIZE)
+                for prefix, value in iter_json_items(chunks, 'errors', *prefixes):
+                    if prefix == 'errors':
+                        errors = value
+                        continue
+                    found = True
+                    yield prefix, value
+            except requests.ConnectionError as e:
+                # a read timeout while streaming surfaces as ConnectionError
+                if e.args and isinstance(e.args[0], ReadTimeoutError):
+                    raise requests.ReadTimeout(e)
+                raise
+            if errors and not found:
+                raise GraphqlException('; '.join(
+                    e.get('message', str(e)) for e in errors))
+
+    def get_graphql_node_names(self, **kwargs):
+        query = '{ allNodes { nodes { name } } }'
+        return [name for _, name in self.iter_graphql(query, NODE_NAMES, **kwargs)]
+
+    def iter_node_flows(self, node, fields, page_size=FLOW_PAGE_SIZE, **kwargs):
+        """Yield flow entries of one node - page by page using the cursor."""
+        cursor = None
+        while True:
+            after = ', after: {}'.format(json.dumps(cursor)) if cursor else ''
+            query = FLOW_QUERY.format(node=json.dumps(node), first=page_size,
+                                      after=after, fields='\n          '.join(fields))
+            page_info = {}
+            for prefix, value in self.iter_graphql(
+                    query, FLOW_ENTRIES, FLOW_PAGE_INFO, **kwargs):
+                if prefix == FLOW_PAGE_INFO:
+                    page_info = value or {}
+                else:
+                    yield value
+            cursor = page_info.get('endCursor')
+            if not page_info.get('hasNextPage') or not cursor:
+                break
+
+    def iter_flows(self, fields, page_size=FLOW_PAGE_SIZE, nodes=None, **kwargs):
+        """Yield flow entries of all nodes.
+
+        Each node is paginated in its own thread, so no single request has to
+        carry the whole flow table. The name of the node is added to each flow
+        as "nodeName".
+        """
+        if nodes is None:
+            nodes = self.get_graphql_node_names(**kwargs)
+        flows = queue.Queue(maxsize=page_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    flows.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker(node):
+            try:
+                for flow in self.iter_node_flows(node, fields, page_size, **kwargs):
+                    flow['nodeName'] = node
+                    if not put(flow):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        threads = [threading.Thread(target=worker, args=(node,), daemon=True)
+                   for node in nodes]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                item = flows.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+    def delete_session(self, router, node, id):
+        location = '/router/{}/node/{}/traffic/session?sessionId={}'.format(
+            router, node, id)
+        try:
+            request = self.delete(location)
+        except requests.RequestException as e:
+            return False, str(e)
+        if request.ok:
+            return True, ''
+        return False, '{} ({})'.format(request.text, request.status_code)
+
+    def delete_sessions(self, sessions, router=None, node=None, max_workers=None):
+        """Delete sessions concurrently.
+
+        sessions is either a list of session ids or a dict, which maps session
+        ids to the node holding them. Router and default node are resolved only
+        once. Returns a dict of session id -> (success, error message).
+        """
+        if not isinstance(sessions, dict):
+            sessions = dict.fromkeys(sessions)
+        if not sessions:
+            return {}
+        if router is None:
+            router = getattr(self, 'router_name', None) or self.get_router_name()
+        if node is None and None in sessions.values():
+            node = getattr(self, 'node_name', None) or self.get_node_name(router)
+        ids = list(sessions)
+        results = self.map(
+            lambda id: self.delete_session(router, sessions[id] or node, id),
+            ids, max_workers)
+        return dict(zip(ids, results))
+
     def commit(self):
         return self.post('/config/commit', {})
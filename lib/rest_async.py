@@ -0,0 +1,216 @@
+import asyncio
+import json as jsonlib
+import os
+import pathlib
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError('The asyncio API needs aiohttp - install it with: '
+                      'pip3 install -r requirements-async.txt')
+
+from lib.rest import UnauthorizedException, write_token_file
+
+
+MAX_CONCURRENCY = 100
+POOL_SIZE = 100
+KEEPALIVE_TIMEOUT = 60
+
+
+class Response(object):
+    """Minimal requests-like response, which has been read completely."""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+
+class AsyncRestGraphqlApi(object):
+    """Representation of REST connection based on asyncio.
+
+    Same methods as RestGraphqlApi, but they are coroutines. All requests
+    share one connection pool with keep-alive and at most max_concurrency
+    requests are in flight at the same time.
+    """
+
+    token = None
+
+    def __init__(self, host='localhost', verify=False, user='admin', password=None, app=__file__,
+                 max_concurrency=MAX_CONCURRENCY, pool_size=POOL_SIZE,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.host = host
+        self.verify = verify
+        self.user = user
+        self.password = password
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        basename = os.path.basename(app).split('.')[0]
+        self.user_agent = basename
+        self.token_file = os.path.join(
+             pathlib.Path.home(), '.{}.token'.format(basename))
+        self.read_token()
+        self.max_login_attempts = 3
+        self.remaining_login_attempts = self.max_login_attempts
+        self.connection_timeout = 3
+        self.read_timeout = 30
+        # created in the running event loop
+        self.session = None
+        self.semaphore = None
+        self.login_lock = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ssl=None if self.verify else False)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self.connection_timeout, sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout, headers={
+                    'Content-Type': 'application/json',
+                    'User-Agent': self.user_agent,
+                })
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.login_lock = asyncio.Lock()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def read_token(self):
+        try:
+            with open(self.token_file) as fd:
+                self.token = fd.read()
+        except FileNotFoundError:
+            pass
+
+    def write_token(self):
+        write_token_file(self.token_file, self.token)
+
+    async def send(self, method, url, json=None, authorization_required=True, **kwargs):
+        headers = dict(kwargs.pop('headers', {}))
+        if authorization_required:
+            headers['Authorization'] = f'Bearer {self.token}'
+        async with self.session.request(method, url, json=json, headers=headers,
+                                        **kwargs) as r:
+            return Response(r.status, await r.read(), r.headers)
+
+    async def request(self, method, location, json=None, authorization_required=True, **kwargs):
+        """Send a request per REST API and refresh the token if needed."""
+        self.open()
+        url = 'https://{}/api/v1/{}'.format(self.host, location.strip('/'))
+        async with self.semaphore:
+            token = self.token
+            r = await self.send(method, url, json, authorization_required, **kwargs)
+            if r.status_code == 401 and authorization_required:
+                if await self.refresh_token(token):
+                    r = await self.send(method, url, json, authorization_required, **kwargs)
+            elif authorization_required:
+                # reset login counter
+                self.remaining_login_attempts = self.max_login_attempts
+        return r
+
+    async def refresh_token(self, expired_token):
+        """Login again - only once for all requests with the same expired token."""
+        async with self.login_lock:
+            if self.token != expired_token:
+                # another request has already logged in
+                return True
+            if not self.remaining_login_attempts:
+                return False
+            self.remaining_login_attempts -= 1
+            await self.login()
+            return True
+
+    async def get(self, location, authorization_required=True, **kwargs):
+        """Get data per REST API."""
+        return await self.request('GET', location, None, authorization_required, **kwargs)
+
+    async def post(self, location, json, authorization_required=True, **kwargs):
+        """Send data per REST API via post."""
+        return await self.request('POST', location, json, authorization_required, **kwargs)
+
+    async def patch(self, location, json, authorization_required=True, **kwargs):
+        """Send data per REST API via patch."""
+        return await self.request('PATCH', location, json, authorization_required, **kwargs)
+
+    async def delete(self, location, authorization_required=True, **kwargs):
+        """Delete object per REST API."""
+        return await self.request('DELETE', location, None, authorization_required, **kwargs)
+
+    async def login(self):
+        json = {
+            'username': self.user,
+        }
+        if self.password:
+            json['password'] = self.password
+        else:
+            key_file = 'pdc_ssh_key'
+            if not os.path.isfile(key_file):
+                key_file = '/home/admin/.ssh/pdc_ssh_key'
+
+            key_content = ''
+            with open(key_file) as fd:
+                key_content = fd.read()
+            json['local'] = key_content
+        url = 'https://{}/api/v1/login'.format(self.host)
+        request = await self.send('POST', url, json, authorization_required=False)
+        if request.status_code == 200:
+            self.token = request.json()['token']
+            self.write_token()
+            return self.token
+        else:
+            message = request.json()['message']
+            raise UnauthorizedException(message)
+
+    async def map(self, func, items):
+        """Await func for all items concurrently - results keep the order of items."""
+        return await asyncio.gather(*(func(item) for item in items))
+
+    async def get_routers(self):
+        return (await self.get('/router')).json()
+
+    async def get_router_name(self):
+        self.router_name = (await self.get_routers())[0]['name']
+        return self.router_name
+
+    async def get_router_names(self):
+        return [r['name'] for r in await self.get_routers()]
+
+    async def get_nodes(self, router):
+        return (await self.get('/config/running/authority/router/{}/node'.format(
+            router))).json()
+
+    async def get_node_names(self, router):
+        nodes = await self.get_nodes(router)
+        node_names = [node['name'] for node in nodes]
+        return node_names
+
+    async def get_device_interfaces(self, router, node):
+        return (await self.get(('/config/running/authority/router/{}/node/{}'
+                                '/device-interface').format(router, node))).json()
+
+    async def commit(self):
+        return await self.post('/config/commit', {})
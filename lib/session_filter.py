@@ -0,0 +1,236 @@
+from fnmatch import fnmatchcase
+from ipaddress import ip_address, ip_network
+import operator
+import re
+import time
+
+from lib.flow_table import NONE
+
+
+# filter keys and the flow fields they are checked on
+KEYS = {
+    'service': ('serviceName',),
+    'protocol': ('protocol',),
+    'interface': ('networkInterfaceName',),
+    'node': ('nodeName',),
+    'ip': ('sourceIp', 'destIp'),
+    'src': ('sourceIp',),
+    'dst': ('destIp',),
+    'port': ('sourcePort', 'destPort'),
+    'sport': ('sourcePort',),
+    'dport': ('destPort',),
+    'encrypted': ('encrypted',),
+    'age': ('startTime',),
+    'same-interface': ('networkInterfaceName',),
+}
+ADDRESS_KEYS = ('ip', 'src', 'dst')
+PORT_KEYS = ('port', 'sport', 'dport')
+BOOLEANS = {
+    'yes': True,
+    'true': True,
+    '1': True,
+    'no': False,
+    'false': False,
+    '0': False,
+}
+COMPARISONS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+}
+INTERNAL_APPLICATION = '<InternalApplication>'
+TERM = re.compile(r'([a-z-]+)(?:(!=|=|<=|>=|<|>)(.*))?')
+DURATION = re.compile(r'(\d+)([smhd]?)')
+PORT_RANGE = re.compile(r'(\d+)(?:-(\d+))?')
+
+
+class FilterException(Exception):
+    pass
+
+
+class PrefixIndex(object):
+    """Index of ip prefixes - one hash set per ip version and prefix length."""
+
+    def __init__(self, prefixes):
+        self.networks = {}
+        for prefix in prefixes:
+            try:
+                network = ip_network(prefix, strict=False)
+            except ValueError:
+                raise FilterException('Invalid prefix: {}'.format(prefix))
+            key = (network.version, network.prefixlen)
+            self.networks.setdefault(key, set()).add(int(network.network_address))
+        self.masks = []
+        for (version, length), networks in self.networks.items():
+            bits = 32 if version == 4 else 128
+            mask = (1 << bits) - (1 << (bits - length))
+            self.masks.append((version, mask, networks))
+
+    def __contains__(self, address):
+        try:
+            address = ip_address(address)
+        except ValueError:
+            return False
+        value = int(address)
+        for version, mask, networks in self.masks:
+            if version == address.version and value & mask in networks:
+                return True
+        return False
+
+
+class Term(object):
+    """One criterion of a filter, e.g. "port=500,4500" or "age>1h"."""
+
+    def __init__(self, text):
+        match = TERM.fullmatch(text)
+        if not match or match.group(1) not in KEYS:
+            raise FilterException('Invalid filter term: {}'.format(text))
+        self.key, self.operator, value = match.groups()
+        self.negate = self.operator == '!='
+        self.fields = KEYS[self.key]
+        if self.key == 'same-interface':
+            if self.operator not in (None, '=', '!='):
+                raise FilterException('Invalid operator: {}'.format(text))
+            self.value = BOOLEANS.get(value.lower()) if value is not None else True
+            if self.value is None:
+                raise FilterException('Invalid boolean: {}'.format(text))
+            return
+        if not value:
+            raise FilterException('Missing value: {}'.format(text))
+
+        if self.key == 'age':
+            if self.operator not in COMPARISONS:
+                raise FilterException('Age needs one of {}: {}'.format(
+                    ' '.join(COMPARISONS), text))
+            self.value = parse_duration(value)
+            return
+        if self.operator not in ('=', '!='):
+            raise FilterException('Invalid operator: {}'.format(text))
+
+        values = value.split(',')
+        if self.key == 'encrypted':
+            self.value = BOOLEANS.get(value.lower())
+            if self.value is None:
+                raise FilterException('Invalid boolean: {}'.format(text))
+        elif self.key in PORT_KEYS:
+            self.value = set()
+            for port in values:
+                match = PORT_RANGE.fullmatch(port)
+                if not match:
+                    raise FilterException('Invalid port range: {}'.format(port))
+                first = int(match.group(1))
+                last = int(match.group(2) or first)
+                self.value.update(range(first, last + 1))
+        elif self.key in ADDRESS_KEYS:
+            self.value = PrefixIndex(values)
+        elif self.key == 'protocol':
+            self.value = [v.upper() for v in values]
+        else:
+            self.value = values
+
+    def matching_codes(self, table):
+        """Return the codes of all values in the table, which match the term."""
+        codes = set()
+        for field in self.fields:
+            codes.update(table.column(field))
+        if self.key in ADDRESS_KEYS:
+            return {code for code in codes if table.values[code] in self.value}
+        patterns = self.value
+        return {code for code in codes
+                if isinstance(table.values[code], str) and
+                any(fnmatchcase(table.values[code], pattern) for pattern in patterns)}
+
+    def compile(self, table, now):
+        """Return a function, which checks a row (or rows for session terms)."""
+        negate = self.negate
+        columns = [table.column(field) for field in self.fields]
+        if self.key == 'same-interface':
+            interfaces = columns[0]
+            internal_application = table.code(INTERNAL_APPLICATION)
+            expected = self.value != negate
+
+            def same_interface(rows):
+                same = len(set(interfaces[rows.start:rows.stop])) == 1 and \
+                       interfaces[rows.start] != internal_application
+                return same == expected
+            return same_interface
+
+        if self.key == 'age':
+            compare = COMPARISONS[self.operator]
+            start_times = columns[0]
+            seconds = self.value
+            return lambda row: start_times[row] != NONE and \
+                               compare(now - start_times[row], seconds)
+        if self.key == 'encrypted':
+            value = int(self.value)
+            encrypted = columns[0]
+            return lambda row: (encrypted[row] == value) != negate
+
+        if self.key in PORT_KEYS:
+            values = self.value
+        else:
+            values = self.matching_codes(table)
+        if len(columns) == 1:
+            column = columns[0]
+            return lambda row: (column[row] in values) != negate
+        first, second = columns
+        return lambda row: (first[row] in values or second[row] in values) != negate
+
+
+class SessionFilter(object):
+    """Filters in a small language, compiled into one predicate per flow table.
+
+    A filter is a list of terms separated by spaces, e.g.
+    "service=internet,voice* dst=10.0.0.0/8 port=443,8000-8100 age>1h".
+    A session matches a filter, if one of its flows matches all flow terms
+    and all session terms (same-interface) are true. A session matches
+    the SessionFilter, if it matches any of its filters.
+    """
+
+    def __init__(self, filters):
+        self.filters = [[Term(text) for text in f.split()] for f in filters]
+
+    @property
+    def fields(self):
+        """Flow fields, which are needed to evaluate the filters."""
+        fields = []
+        for terms in self.filters:
+            for term in terms:
+                fields.extend(f for f in term.fields if f not in fields)
+        return fields
+
+    def compile(self, table, now=None):
+        """Return a function, which checks if a session (range of rows) matches."""
+        if now is None:
+            now = int(time.time())
+        rules = []
+        for terms in self.filters:
+            session_checks = [t.compile(table, now) for t in terms if t.key == 'same-interface']
+            flow_checks = [t.compile(table, now) for t in terms if t.key != 'same-interface']
+            rules.append((session_checks, flow_checks))
+
+        def match(rows):
+            for session_checks, flow_checks in rules:
+                if not all(check(rows) for check in session_checks):
+                    continue
+                if not flow_checks:
+                    return True
+                for row in rows:
+                    if all(check(row) for check in flow_checks):
+                        return True
+            return False
+        return match
+
+
+def parse_duration(text):
+    match = DURATION.fullmatch(text)
+    if not match:
+        raise FilterException('Invalid duration: {}'.format(text))
+    return int(match.group(1)) * UNITS[match.group(2) or 's']
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.log import *
+from lib.mock_conductor import FILE_SIZE, FLOWS, NODES, ROUTERS, SERVICES, USERS, \
+    Fleet, MockConductor
+
+
+def parse_arguments():
+    """Get commandline arguments."""
+    parser = argparse.ArgumentParser(
+        description='Run a local HTTPS server, which emulates the API of a 128T/SSR conductor')
+    parser.add_argument('--listen', default='localhost',
+                        help='address to listen on (default: localhost)')
+    parser.add_argument('--port', type=int, default=443,
+                        help='port to listen on (default: 443)')
+    parser.add_argument('--routers', type=int, default=ROUTERS,
+                        help='number of routers (default: {})'.format(ROUTERS))
+    parser.add_argument('--nodes', type=int, default=NODES,
+                        help='number of nodes per router (default: {})'.format(NODES))
+    parser.add_argument('--flows', type=int, default=FLOWS,
+                        help='number of flows per node (default: {})'.format(FLOWS))
+    parser.add_argument('--services', type=int, default=SERVICES,
+                        help='number of services (default: {})'.format(SERVICES))
+    parser.add_argument('--users', type=int, default=USERS,
+                        help='number of users (default: {})'.format(USERS))
+    parser.add_argument('--file-size', type=int, default=FILE_SIZE,
+                        help='size of log files in bytes (default: {})'.format(FILE_SIZE))
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay each request by X seconds')
+    parser.add_argument('--token-lifetime', type=float,
+                        help='expire tokens after X seconds')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic data')
+    parser.add_argument('--cert', help='certificate file (default: self-signed)')
+    parser.add_argument('--key', help='key file of the certificate')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log each request')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    fleet = Fleet(args.routers, args.nodes, args.flows, args.services, args.users,
+                  args.file_size, args.seed)
+    try:
+        server = MockConductor(fleet, args.listen, args.port, args.latency,
+                               args.token_lifetime, args.cert, args.key, args.verbose)
+    except OSError as e:
+        error('Cannot start server:', e)
+    info('Listening on https://{}/api/v1/'.format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for request, count in sorted(server.requests.items()):
+            print('{:8d} {}'.format(count, request))
+
+
+if __name__ == '__main__':
+    main()
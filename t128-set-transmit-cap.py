@@ -26,6 +26,8 @@ def parse_arguments():
                         help='Transmit cap to be set')
     parser.add_argument('--commit', action='store_true',
                         help='Commit config after change')
+    parser.add_argument('--cache', action='store_true',
+                        help='Cache router/node/interface lookups on disk between runs')
     return parser.parse_args()
 
 
@@ -48,6 +50,8 @@ def main():
         if args.user and args.password:
             params['user'] = args.user
             params['password'] = args.password
+    if args.cache:
+        params['cache'] = 'disk'
     api = RestGraphqlApi(**params)
 
     router = args.router
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from functools import lru_cache
 import json
 from ipaddress import ip_network
 from requests.exceptions import ConnectionError
@@ -25,22 +26,81 @@ def parse_arguments():
                         help='Read services config from json file, which was created by this tool before')
     parser.add_argument('--dump-json', action='store_true',
                         help='Write config dump to json file "t128-show-ip-prefix-conflicts.json"')
+    parser.add_argument('--cross-service', action='store_true',
+                        help='Show overlapping prefixes between different services')
     return parser.parse_args()
 
 
-def broadcast_address(network):
+@lru_cache(maxsize=None)
+def address_range(network):
+    """Return (ip version, first address, last address) as integers."""
     try:
-        return ip_network(network).broadcast_address
+        network = ip_network(network)
     except ValueError:
         # warn(f'Invalid network address: {network}')
         return None
-
-def have_conflict(ref_address, comp_address):
-    ref_broadcast = broadcast_address(ref_address)
-    comp_broadcast = broadcast_address(comp_address)
-    if ref_broadcast and comp_broadcast:
-        return ref_broadcast == comp_broadcast
-    return False
+    return (network.version, int(network.network_address),
+            int(network.broadcast_address))
+
+
+def overlapping_pairs(ranges):
+    """Find all index pairs (i < j) of overlapping address ranges.
+
+    The ranges are sorted by start address (and descending end address)
+    and swept once. Two prefixes are either disjoint or nested, so all
+    prefixes containing the current one are on a stack of open ranges.
+    """
+    entries = sorted((r[0], r[1], -r[2], index)
+                     for index, r in enumerate(ranges) if r)
+    pairs = []
+    stack = []
+    for version, start, end, index in entries:
+        while stack and (stack[-1][0] != version or stack[-1][1] < start):
+            stack.pop()
+        for _, _, other in stack:
+            pairs.append((min(index, other), max(index, other)))
+        stack.append((version, -end, index))
+    pairs.sort()
+    return pairs
+
+
+def find_conflicts(addresses):
+    """Find all pairs of overlapping prefixes (equal or containing)."""
+    ranges = [address_range(address) for address in addresses]
+    return [(addresses[i], addresses[j]) for i, j in overlapping_pairs(ranges)]
+
+
+def find_cross_service_conflicts(services):
+    """Find overlapping prefixes of different services.
+
+    services is a list of (name, addresses). All prefixes go into one index,
+    the result maps service name pairs to a list of
+    (address, address, most specific service or None if equal).
+    """
+    owners = []
+    addresses = []
+    for owner, (_, service_addresses) in enumerate(services):
+        for address in service_addresses:
+            owners.append(owner)
+            addresses.append(address)
+    ranges = [address_range(address) for address in addresses]
+
+    conflicts = {}
+    for i, j in overlapping_pairs(ranges):
+        if owners[i] == owners[j]:
+            continue
+        if owners[i] > owners[j]:
+            i, j = j, i
+        size_i = ranges[i][2] - ranges[i][1]
+        size_j = ranges[j][2] - ranges[j][1]
+        if size_i == size_j:
+            winner = None
+        else:
+            winner = services[owners[i] if size_i < size_j else owners[j]][0]
+        key = (owners[i], owners[j])
+        conflicts.setdefault(key, []).append((addresses[i], addresses[j], winner))
+    return {(services[a][0], services[b][0]): conflicts[(a, b)]
+            for a, b in sorted(conflicts)}
 
 
 def main():
@@ -76,7 +136,7 @@ def main():
     if not services:
         error('Could not find any service to be checked.')
 
-    conflicts = False
+    checked_services = []
     for service in services:
         if type(service) != dict:
             error('File is not in a valid format.')
@@ -106,20 +166,28 @@ def main():
 
             error('Service has got no addresses:', name)
 
-        conflicting_addresses = []
-        for ref_address in addresses:
-            next_index = addresses.index(ref_address) + 1
-            if next_index >= len(addresses):
-                break
-            for comp_address in addresses[next_index:]:
-                if have_conflict(ref_address, comp_address):
-                    conflicting_addresses.append((ref_address, comp_address))
+        checked_services.append((name, addresses or []))
 
-        if conflicting_addresses:
+    conflicts = False
+    if args.cross_service:
+        for (name, other_name), conflicting_addresses in \
+                find_cross_service_conflicts(checked_services).items():
             conflicts = True
-            warn(f'Service "{name}" has conflicting addresses:')
-            for conflict in conflicting_addresses:
-                print('* {} and {}'.format(*conflict))
+            warn(f'Services "{name}" and "{other_name}" have conflicting addresses:')
+            for address, other_address, winner in conflicting_addresses:
+                if winner:
+                    result = f'"{winner}" is more specific'
+                else:
+                    result = 'equal prefixes'
+                print(f'* {address} and {other_address} ({result})')
+    else:
+        for name, addresses in checked_services:
+            conflicting_addresses = find_conflicts(addresses)
+            if conflicting_addresses:
+                conflicts = True
+                warn(f'Service "{name}" has conflicting addresses:')
+                for conflict in conflicting_addresses:
+                    print('* {} and {}'.format(*conflict))
 
     if not conflicts:
             info('No conflicts have been found.')
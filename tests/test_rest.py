@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from lib.rest import iter_json_items
+
+
+DOCUMENT = '''{
+  "data": {
+    "items": [1.5, -2.5e10, 3E-2, 0, 42, -7, 1e+3, "ä€", true, null,
+              {"a": [1, 2.25], "b": "x y"}, [], {}],
+    "count": 13,
+    "ratio": 0.125
+  }
+}'''
+
+
+class IterJsonItemsTest(unittest.TestCase):
+
+    def expected(self):
+        data = json.loads(DOCUMENT)['data']
+        items = [('data.items.item', item) for item in data['items']]
+        return items + [('data.count', data['count']), ('data.ratio', data['ratio'])]
+
+    def test_split_at_every_offset(self):
+        document = DOCUMENT.encode()
+        for offset in range(len(document) + 1):
+            chunks = [document[:offset], document[offset:]]
+            items = list(iter_json_items(chunks, 'data.items.item', 'data.count',
+                                         'data.ratio'))
+            self.assertEqual(items, self.expected(), 'split at {}'.format(offset))
+
+    def test_single_bytes(self):
+        document = DOCUMENT.encode()
+        chunks = [document[i:i + 1] for i in range(len(document))]
+        items = list(iter_json_items(chunks, 'data.items.item', 'data.count', 'data.ratio'))
+        self.assertEqual(items, self.expected())
+
+    def test_invalid_number(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_items([b'[1.', b']'], 'item'))
+
+
+if __name__ == '__main__':
+    unittest.main()